@@ -0,0 +1,109 @@
+'''
+Check that pipelines run concurrently on a thread pool give the same
+results as serial runs, and time both.
+
+    python benchmarks/bench_concurrency.py -n 16 --workers 4
+
+N synthetic plot images are processed once serially and once with
+batch.process_all on a thread pool. The processed images and contours of
+each image must be identical, and the speedup of the threads is
+reported; OpenCV releases the GIL, so it grows with the number of cores.
+A single pipeline shared by the threads is also driven concurrently, to
+check that its lock keeps the stage chain consistent. Exits with status
+1 when any result differs.
+'''
+import os
+import sys
+import time
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2 as cv
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'matplotcv'))
+
+from pipeline import Pipeline, sizes  # noqa: E402
+from batch import process, process_all  # noqa: E402
+from bench_pipeline import synthetic_plot  # noqa: E402
+
+
+def same(a: Pipeline, b: Pipeline) -> bool:
+    '''Whether two pipelines hold the same processed image and contours.'''
+    return np.array_equal(a.processed, b.processed) and all(
+        np.array_equal(x, y)
+        for x, y in zip(a.contours.to_arrays(), b.contours.to_arrays())
+    )
+
+
+def shared_pipeline(path: str, workers: int, rounds: int) -> bool:
+    '''
+    Change the blur level of one pipeline from several threads at once.
+    Each change must leave the result of the final chain in place.
+    '''
+    pipeline = Pipeline()
+    pipeline.load_image(path)
+    pipeline.gray()
+    pipeline.blur('gaussian', 1)
+    pipeline.edges()
+
+    expected = {}
+    for n in range(1, 4):
+        p = Pipeline()
+        p.load_image(path)
+        p.gray()
+        p.blur('gaussian', n)
+        p.edges()
+        expected[n] = p.processed
+
+    def tweak(i: int) -> bool:
+        n = 1 + i % 3
+        with pipeline.lock:
+            pipeline.set_stage(1, 'gaussian', n)
+            return np.array_equal(pipeline.processed, expected[n])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return all(executor.map(tweak, range(rounds)))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Compare concurrent and serial pipeline runs.'
+    )
+    parser.add_argument('-n', type=int, default=16, help='Number of images')
+    parser.add_argument('--size', choices=sizes, default='fhd')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--density', type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for i in range(args.n):
+            path = os.path.join(tmp, f'{i}.png')
+            cv.imwrite(path, synthetic_plot(sizes[args.size], args.density, i))
+            files.append(path)
+
+        start = time.perf_counter()
+        serial = [process(f) for f in files]
+        serial_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        threaded = process_all(files, workers=args.workers)
+        threaded_time = time.perf_counter() - start
+
+        mismatches = sum(not same(a, b) for a, b in zip(serial, threaded))
+        shared = shared_pipeline(files[0], args.workers, 4 * args.workers)
+
+    print(f'{args.n} images at {args.size}, {args.workers} threads')
+    print(f'serial   {serial_time:8.2f} s')
+    print(
+        f'threads  {threaded_time:8.2f} s'
+        f'  ({serial_time / threaded_time:.2f}x)'
+    )
+    print(f'identical results: {args.n - mismatches}/{args.n}')
+    print(f'shared pipeline consistent: {shared}')
+    return 1 if mismatches or not shared else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+'''
+Compare the batched distance kernels in metrics against the scalar
+point_segment_distance called in a Python loop.
+
+    python benchmarks/bench_metrics.py [--points N] [--vertices N]
+'''
+import os
+import sys
+import argparse
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'matplotcv'))
+
+from metrics import (  # noqa: E402
+    point_segment_distance,
+    points_polyline_distance,
+    point_polylines_distance,
+    nearest_segment,
+)
+
+
+def scalar_points_polyline(points, polyline):
+    return [
+        min(
+            point_segment_distance(p, (polyline[i], polyline[i + 1]))
+            for i in range(len(polyline) - 1)
+        ) for p in points
+    ]
+
+
+def scalar_point_polylines(point, polylines):
+    return [
+        min(
+            point_segment_distance(point, (p[i], p[i + 1]))
+            for i in range(len(p) - 1)
+        ) for p in polylines
+    ]
+
+
+def scalar_nearest_segment(point, polyline):
+    distances = [
+        point_segment_distance(point, (polyline[i], polyline[i + 1]))
+        for i in range(len(polyline) - 1)
+    ]
+    i = min(range(len(distances)), key=distances.__getitem__)
+    return i, distances[i]
+
+
+def measure(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--points', type=int, default=200)
+    parser.add_argument('--vertices', type=int, default=500)
+    parser.add_argument('--polylines', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    points = rng.uniform(0, 1000, [args.points, 2])
+    polyline = np.cumsum(rng.normal(0, 5, [args.vertices, 2]), axis=0)
+    polylines = [
+        np.cumsum(rng.normal(0, 5, [10, 2]), axis=0) + rng.uniform(0, 1000)
+        for _ in range(args.polylines)
+    ]
+
+    cases = {
+        'points_polyline_distance': (
+            lambda: scalar_points_polyline(points, polyline),
+            lambda: points_polyline_distance(points, polyline),
+        ),
+        'point_polylines_distance': (
+            lambda: scalar_point_polylines(points[0], polylines),
+            lambda: point_polylines_distance(points[0], polylines),
+        ),
+        'nearest_segment': (
+            lambda: scalar_nearest_segment(points[0], polyline),
+            lambda: nearest_segment(points[0], polyline),
+        ),
+    }
+
+    print(f'{"kernel":<28}{"scalar, s":>12}{"batched, s":>12}{"speedup":>10}')
+    for name, (scalar, batched) in cases.items():
+        ts = measure(scalar, args.repeat)
+        tb = measure(batched, args.repeat)
+        print(f'{name:<28}{ts:>12.4f}{tb:>12.4f}{ts / tb:>9.0f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+'''
+Time Pipeline operations at each size preset on synthetic plot images.
+
+    python benchmarks/bench_pipeline.py -o results.json
+    python benchmarks/bench_pipeline.py --compare results.json
+
+Each operation is run on a fresh pipeline prepared up to the preceding
+stage. The reported time is the best of the repeats and the peak memory
+is the largest amount of memory allocated by the operation as traced by
+tracemalloc, which covers NumPy and OpenCV arrays.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+import cv2 as cv
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'matplotcv'))
+
+from pipeline import Pipeline, sizes  # noqa: E402
+from common import commit, compare  # noqa: E402
+
+
+def synthetic_plot(size: tuple[int], density: int, seed: int = 0):
+    '''
+    Draw a plot-like image: axes with ticks and density noisy curves.
+    '''
+    w, h = size
+    rng = np.random.default_rng(seed)
+    image = np.full([h, w, 3], 255, dtype=np.uint8)
+
+    x0, y0, x1, y1 = w // 10, h // 10, 9 * w // 10, 9 * h // 10
+    cv.rectangle(image, (x0, y0), (x1, y1), (0, 0, 0), max(1, w // 640))
+    for x in np.linspace(x0, x1, 11).astype(int):
+        cv.line(image, (x, y1), (x, y1 + h // 50), (0, 0, 0), 1)
+    for y in np.linspace(y0, y1, 11).astype(int):
+        cv.line(image, (x0 - w // 50, y), (x0, y), (0, 0, 0), 1)
+
+    x = np.linspace(x0, x1, 400)
+    for _ in range(density):
+        y = (
+            (y0 + y1) / 2 + rng.uniform(0.1, 0.4) * (y1 - y0) *
+            np.sin(x / w * rng.uniform(2, 20) + rng.uniform(0, 6))
+        )
+        color = tuple(int(c) for c in rng.integers(0, 200, 3))
+        curve = np.stack([x, y], axis=1).astype(np.int32)
+        cv.polylines(image, [curve], False, color, max(1, w // 960))
+
+    return image
+
+
+def largest_contour(p: Pipeline) -> int:
+    return max(p.contours, key=lambda k: len(p.contours[k].points))
+
+
+def operations(path: str, source_path: str, size: str):
+    '''Pairs of (setup, operation) for each benchmarked operation.'''
+    jpeg_path = os.path.splitext(source_path)[0] + '.jpg'
+
+    def loaded():
+        p = Pipeline()
+        p.load_image(path)
+        return p
+
+    def upto(*stages):
+
+        def setup():
+            p = loaded()
+            for stage in stages:
+                stage(p)
+            return p
+
+        return setup
+
+    def resize_source():
+        p = Pipeline()
+        p.load_image(source_path)
+        return p
+
+    gray = Pipeline.gray
+    blur = Pipeline.blur
+    edges = Pipeline.edges
+    find = Pipeline.find_contours
+
+    return {
+        'load_image': (Pipeline, lambda p: p.load_image(path)),
+        'resize': (resize_source, lambda p: p.resize(size)),
+        'load_resized': (Pipeline, lambda p: p.load_image(jpeg_path, size)),
+        'gray': (loaded, gray),
+        'blur': (upto(gray), blur),
+        'edges': (upto(gray, blur), edges),
+        'threshold': (upto(gray, blur), Pipeline.threshold),
+        'find_contours': (upto(gray, blur, edges), find),
+        'display_image': (
+            upto(gray, blur, edges),
+            lambda p: p.display_image('processed', 2),
+        ),
+        'split_contour': (
+            upto(gray, blur, edges, find),
+            lambda p: p.split_contour(largest_contour(p)),
+        ),
+        'contour_roi': (
+            upto(gray, blur, edges, find),
+            lambda p: [p.contour_roi(k) for k in p.contours],
+        ),
+    }
+
+
+def measure(setup, operation, repeat: int) -> tuple[float]:
+    operation(setup())  # Warm up lazy imports and caches
+
+    best, peak = float('inf'), 0
+    for _ in range(repeat):
+        state = setup()
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        operation(state)
+        elapsed = time.perf_counter() - start
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+        best = min(best, elapsed)
+    return best, peak
+
+
+def run(presets: list[str], density: int, repeat: int) -> list[dict]:
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in presets:
+            w, h = sizes[size]
+            path = os.path.join(tmp, f'{size}.png')
+            source_path = os.path.join(tmp, f'{size}_source.png')
+            cv.imwrite(path, synthetic_plot((w, h), density))
+            source = synthetic_plot((3 * w // 2, 3 * h // 2), density)
+            cv.imwrite(source_path, source)
+            cv.imwrite(os.path.join(tmp, f'{size}_source.jpg'), source)
+
+            for name, (setup, operation) in operations(
+                path, source_path, size
+            ).items():
+                elapsed, peak = measure(setup, operation, repeat)
+                results.append(
+                    {
+                        'operation': name,
+                        'size': size,
+                        'density': density,
+                        'time': elapsed,
+                        'peak_memory': peak,
+                    }
+                )
+                print(
+                    f'{size:<5}{name:<16}{elapsed * 1e3:>10.2f} ms'
+                    f'{peak / 2**20:>10.1f} MiB'
+                )
+    return results
+
+
+def key(result: dict) -> tuple:
+    return result['operation'], result['size'], result['density']
+
+
+def label(result: dict) -> str:
+    return f'{result["size"]:<5}{result["operation"]:<16}'
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmark Pipeline operations.'
+    )
+    parser.add_argument(
+        '--sizes', nargs='+', choices=sizes, default=list(sizes)
+    )
+    parser.add_argument(
+        '--density', type=int, default=10, help='Number of plotted curves'
+    )
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help='Write results to JSON file')
+    parser.add_argument('--compare', help='Baseline JSON file')
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.2,
+        help='Relative slowdown reported as a regression'
+    )
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.density, args.repeat)
+    report = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv.__version__,
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.tolerance, key, label):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+'''
+Measure the cold import time of the application modules.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py -o startup.json
+    python benchmarks/bench_startup.py --compare startup.json
+
+Each module is imported in a fresh interpreter with -X importtime and the
+cumulative import time of the module is read from its report, best of the
+repeats. Exits with status 1 when a module exceeds its budget, imports a
+dependency that should only load on first use, or, with --compare, is
+slower than the baseline by more than the tolerance.
+'''
+import os
+import sys
+import json
+import argparse
+import platform
+import subprocess
+
+from common import commit, compare
+
+matplotcv = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'matplotcv'
+)
+
+# Import time budgets in milliseconds
+budgets = {
+    'metrics': 150,
+    'contours': 200,
+    'pipeline': 300,
+    'components': 800,
+    'app': 1000,
+}
+
+# Dependencies no module should import at startup
+deferred = ('matplotlib', 'scipy')
+
+
+def import_time(module: str) -> tuple[float, list[str]]:
+    '''
+    Cumulative import time of the module in seconds, and the deferred
+    dependencies loaded by the import.
+    '''
+    code = (
+        f'import sys, {module}\n'
+        f'print(*[m for m in {deferred!r} if m in sys.modules])'
+    )
+    env = dict(os.environ, KIVY_NO_ARGS='1', KIVY_NO_CONSOLELOG='1')
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=matplotcv,
+        env=env,
+    )
+
+    # Lines of the report are 'import time: self | cumulative | name'
+    elapsed = 0.0
+    for line in process.stderr.splitlines():
+        if line.startswith('import time:'):
+            fields = line.split('|')
+            if fields[-1].strip() == module:
+                elapsed = int(fields[1]) / 1e6
+    return elapsed, process.stdout.split()
+
+
+def run(modules: list[str], repeat: int) -> list[dict]:
+    results = []
+    for module in modules:
+        times, loaded = [], []
+        for _ in range(repeat):
+            elapsed, loaded = import_time(module)
+            times.append(elapsed)
+
+        best = min(times)
+        results.append({'module': module, 'time': best, 'deferred': loaded})
+        print(
+            f'{module:<12}{best * 1e3:>10.1f} ms'
+            f'{budgets[module]:>10} ms budget'
+            f'{"  loads " + ", ".join(loaded) if loaded else ""}'
+        )
+    return results
+
+
+def check(results: list[dict]) -> int:
+    '''Print budget and deferred import violations, return their count.'''
+    failures = 0
+    for r in results:
+        if r['time'] * 1e3 > budgets[r['module']]:
+            failures += 1
+            print(f'{r["module"]}: over budget')
+        if r['deferred']:
+            failures += 1
+            print(f'{r["module"]}: imports {", ".join(r["deferred"])}')
+    return failures
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Benchmark the import time of the application.'
+    )
+    parser.add_argument(
+        '--modules', nargs='+', choices=budgets, default=list(budgets)
+    )
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help='Write results to JSON file')
+    parser.add_argument('--compare', help='Baseline JSON file')
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.2,
+        help='Relative slowdown reported as a regression'
+    )
+    args = parser.parse_args()
+
+    results = run(args.modules, args.repeat)
+    failures = check(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(
+                {
+                    'commit': commit(),
+                    'python': platform.python_version(),
+                    'results': results,
+                },
+                f,
+                indent=2,
+            )
+
+    if args.compare:
+        with open(args.compare) as f:
+            failures += compare(
+                results,
+                json.load(f),
+                args.tolerance,
+                lambda r: r['module'],
+                lambda r: f'{r["module"]:<12}',
+            )
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+'''
+Check that tiled processing gives the same edges and contours as the
+full-frame chain, and time both.
+
+    python benchmarks/bench_tiling.py --size 4k --tile 512
+
+A noisy synthetic plot image is processed by Pipeline.find_contours_tiled
+and by the gray, blur and edges chain of Pipeline followed by
+cv.findContours on the whole image. The edge maps must be identical, and
+the contours found tile by tile must be the same as the full-frame ones,
+including their starting points, up to their order. Exits with status 1
+when they differ.
+'''
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import cv2 as cv
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'matplotcv'))
+
+from pipeline import Pipeline, sizes  # noqa: E402
+from tiling import tiled_contours  # noqa: E402
+from bench_pipeline import synthetic_plot  # noqa: E402
+
+
+def contour_set(contours) -> list[tuple[int]]:
+    return sorted(tuple(c.reshape(-1).tolist()) for c in contours)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Compare tiled and full-frame processing.'
+    )
+    parser.add_argument('--size', choices=sizes, default='4k')
+    parser.add_argument('--tile', type=int, default=512)
+    parser.add_argument('--density', type=int, default=10)
+    args = parser.parse_args()
+
+    image = synthetic_plot(sizes[args.size], args.density)
+    # Noise gives weak edges, which hysteresis follows across tiles
+    noise = np.random.default_rng(0).integers(0, 40, image.shape)
+    image = cv.add(image, noise.astype(np.uint8))
+    p = Pipeline()
+
+    start = time.perf_counter()
+    edges = p.find_contours_tiled(image, args.tile)
+    tiled_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    q = Pipeline()
+    q.load_array(image)
+    q.gray()
+    q.blur()
+    q.edges()
+    full, _ = cv.findContours(
+        q.processed, cv.RETR_LIST, cv.CHAIN_APPROX_SIMPLE
+    )
+    full_time = time.perf_counter() - start
+
+    edges_differ = int(np.count_nonzero(edges != q.processed))
+    tiled = [p.contours.points(k) for k in p.contours]
+    contours_match = contour_set(tiled) == contour_set(full)
+
+    # Contours crossing tile borders in every direction
+    ring = np.zeros([4 * args.tile, 4 * args.tile], dtype=np.uint8)
+    c = 2 * args.tile
+    cv.rectangle(ring, (c // 4, c // 4), (7 * c // 4, 7 * c // 4), 255, 3)
+    cv.circle(ring, (c, c), 3 * c // 4, 255, 1)
+    ring_full, _ = cv.findContours(ring, cv.RETR_LIST, cv.CHAIN_APPROX_SIMPLE)
+    rings_match = contour_set(tiled_contours(ring, args.tile)) == (
+        contour_set(ring_full)
+    )
+
+    print(f'{args.size} image, {args.tile} px tiles')
+    print(f'tiled chain    {tiled_time:8.3f} s')
+    print(f'full frame     {full_time:8.3f} s')
+    print(f'edge pixels differing: {edges_differ}')
+    print(f'contours: {len(tiled)} tiled, {len(full)} full-frame')
+    print(f'same contours: {contours_match}, crossing shapes: {rings_match}')
+    return 0 if not edges_differ and contours_match and rings_match else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,51 @@
+'''
+Helpers shared by the benchmark scripts: the commit the results are
+recorded for and the comparison of results against a baseline file.
+'''
+import os
+import subprocess
+from typing import Callable
+
+
+def commit() -> str | None:
+    '''Hash of the checked out commit, None outside of a git checkout.'''
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(
+    results: list[dict],
+    baseline: dict,
+    tolerance: float,
+    key: Callable[[dict], tuple],
+    label: Callable[[dict], str],
+) -> int:
+    '''
+    Print time ratios against a baseline, return the regression count.
+    Results are matched to the baseline by key and printed after their
+    label.
+    '''
+    base = {key(r): r for r in baseline['results']}
+
+    regressions = 0
+    print(f'\nCompared to {baseline.get("commit")}:')
+    for r in results:
+        b = base.get(key(r))
+        if b is None:
+            continue
+
+        ratio = r['time'] / b['time']
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions += 1
+            flag = '  REGRESSION'
+        print(f'{label(r)}{ratio:>8.2f}x{flag}')
+    return regressions
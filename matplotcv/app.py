@@ -1,15 +1,13 @@
 import os
-import csv
-import cv2 as cv
 import numpy as np
-import random
 
 import kivy
 from kivy.factory import Factory
 from kivy.core.window import Window
 from kivy.app import App
 from kivy.uix.widget import Widget
-from kivy.properties import ObjectProperty
+from kivy.properties import ObjectProperty, BooleanProperty
+from kivy.graphics import InstructionGroup, Color, Rectangle
 from kivy.graphics.texture import Texture
 from kivy.clock import Clock
 from kivy.logger import Logger, LOG_LEVELS
@@ -22,14 +20,19 @@ from components import (
     FileSavePopup,
     ToolsDropDown,
     MathDropDown,
-    ContourWidget,
+    load_kv,
+    ContourLayer,
 )
 from pipeline import Pipeline
-from metrics import affine_map
+from worker import Worker
+from calibration import Calibration
+from export import export_points, formats
 
 kivy.require('2.3.0')
 Logger.setLevel(LOG_LEVELS['debug'])
 
+tile_size = 512  # Pixels of the image tile textures, see upload_texture
+
 
 class MPLWidget(Widget):
     app = ObjectProperty()
@@ -37,19 +40,40 @@ class MPLWidget(Widget):
     scatter = ObjectProperty()
     image = ObjectProperty()
     original_image_toggle = ObjectProperty()
+    busy = BooleanProperty(False)
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
         self.pipeline = Pipeline()
-        self.contours = {}
+        self.worker = Worker(on_busy=lambda busy: setattr(self, 'busy', busy))
+        # Image tiles are drawn below the contours, see upload_texture
+        self.tile_group = InstructionGroup()
+        self.image.canvas.add(self.tile_group)
+        self._tiles = {}  # Tile rectangles by row and column
+        self._tiled_shape = None  # Shape of the pyramid level shown
+        self.clear_tiles()
+
+        self.contour_layer = ContourLayer()
+        self.image.add_widget(self.contour_layer)
+        self.image.bind(
+            pos=lambda *args: self.on_image_layout(),
+            size=lambda *args: self.on_image_layout(),
+        )
         self.marked_contours = set()
         self.drawn_contours = None
-        self._transform_matrix = None
+        self._calibration = None
+        self._texture_state = None
+        self._update_event = None
+
+        self.collide_threshold = self.app.config.getfloat(
+            'Advanced', 'contour_collide_threshold'
+        )
 
         # Initialize and bind components
         Window.bind(
-            on_resize=self.on_window_resize, mouse_pos=self.on_mouse_move
+            mouse_pos=self.on_mouse_move,
+            on_key_down=self.on_key_down,
         )
 
         self.file_loader = FileLoadPopup()
@@ -60,16 +84,26 @@ class MPLWidget(Widget):
 
         self.resize_dropdown = Factory.ResizeDropDown()
         self.resize_dropdown.bind(
-            on_select=lambda i, v: self.pipeline.resize(v)
+            on_select=lambda i, v: self.
+            run_pipeline(self.pipeline.resize, v, channel='resize')
         )
 
         self.tools_dropdown = ToolsDropDown()
-        self.tools_dropdown.bind(on_select=lambda i, v: self.pipeline.gray())
+        self.tools_dropdown.bind(
+            on_select=lambda i, v: self.
+            run_pipeline(self.pipeline.gray, channel='gray')
+        )
         self.tools_dropdown.blur_dropdown.bind(
-            on_select=lambda i, v: self.pipeline.blur(v)
+            on_select=lambda i, v: self.
+            run_pipeline(self.pipeline.blur, v, channel='blur')
         )
         self.tools_dropdown.detect_edges_dropdown.bind(
-            on_select=lambda i, v: self.pipeline.edges(v)
+            on_select=lambda i, v: self.
+            run_pipeline(self.pipeline.edges, v, channel='edges')
+        )
+        self.tools_dropdown.threshold_dropdown.bind(
+            on_select=lambda i, v: self.
+            run_pipeline(self.pipeline.threshold, v, channel='threshold')
         )
 
         self.draw_dropdown = Factory.DrawDropDown()
@@ -82,24 +116,34 @@ class MPLWidget(Widget):
     #---------------------------
     # UI operations
     #---------------------------
-    def on_window_resize(self, instance, w, h):
-        '''Redraw all contours that are currently displayed.'''
-        if self.contours:
-            Clock.unschedule(self.draw_contours)  # Prevent multiple calls
-            Clock.schedule_once(
-                lambda dt: self.draw_contours(redraw=True), 0.1
-            )
+    def on_key_down(self, window, key, scancode, codepoint, modifiers):
+        '''Undo and redo pipeline stages with Ctrl+Z and Ctrl+Y.'''
+        if 'ctrl' in modifiers:
+            match codepoint:
+                case 'z':
+                    self.run_pipeline(self.pipeline.undo)
+                    return True
+                case 'y':
+                    self.run_pipeline(self.pipeline.redo)
+                    return True
+        return False
 
     def on_mouse_move(self, window, pos):
         '''Highlight a contour when the mouse is over it.'''
-        threshold = self.app.config.get(
-            'Advanced', 'contour_collide_threshold'
+        self.contour_layer.hovered = self.contour_at(
+            *self.image.to_widget(*pos)
         )
-        threshold = float(threshold)
 
-        pos = self.image.to_widget(*pos)
-        for contour in self.contours.values():
-            contour.hovered = contour.collide_point(*pos, threshold)
+    def on_touch_down(self, touch):
+        if super().on_touch_down(touch):
+            return True
+
+        if touch.button == 'left':
+            key = self.contour_at(*self.image.to_widget(*touch.pos))
+            if key is not None:
+                self.contour_layer.open_dropdown(key, touch.pos)
+                return True
+        return False
 
     def on_load_from_file_button_press(self, selection):
         if selection:  # Try loading file once confirmed with load button
@@ -107,7 +151,17 @@ class MPLWidget(Widget):
                 self.clear()
 
                 try:
-                    self.pipeline.load_image(selection[0])
+                    # Show a preview while the image is decoded
+                    complete = self.pipeline.load_image(
+                        selection[0], progressive=True
+                    )
+                    if complete is not None:
+                        self.run_pipeline(
+                            complete,
+                            channel='load',
+                            on_done=lambda _: self.
+                            clear_contour(self.contour_layer.keys()),
+                        )
                 except exceptions.PipelineError:
                     error_popup = ErrorPopup()
                     error_popup.message = 'Could not load image'
@@ -117,15 +171,17 @@ class MPLWidget(Widget):
 
                 self.update_image()
 
-                # Sync at 30 FPS
-                Clock.schedule_interval(
-                    lambda interval: self.update_image(), 1 / 30
-                )
+                # Sync at 30 FPS, the texture is only re-uploaded when the
+                # pipeline or the zoom change
+                if self._update_event is None:
+                    self._update_event = Clock.schedule_interval(
+                        lambda interval: self.update_image(), 1 / 30
+                    )
 
     def on_save_to_file_button_press(self, dir: str, name: str):
         path = os.path.join(dir, name)
 
-        if not path.endswith('.csv'):
+        if os.path.splitext(path)[1].lower().lstrip('.') not in formats:
             path += '.csv'
 
         if os.path.exists(path):
@@ -137,6 +193,8 @@ class MPLWidget(Widget):
             confirmation_popup.confirm = lambda: self.write_contour(path)
 
             confirmation_popup.open()
+        else:
+            self.write_contour(path)
 
     def on_original_image_toggle_press(self):
         if self.original_image_toggle.state == 'down':
@@ -148,10 +206,35 @@ class MPLWidget(Widget):
     def on_log_scale_select(self, value):
         self.app.config.set('Math', 'log_scale', value)
         self.app.config.write()
+        self._calibration = None
 
     #---------------------------
     # Image operations
     #---------------------------
+    def run_pipeline(self, operation, *args, channel=None, on_done=None):
+        '''
+        Run a pipeline operation in the background. A new operation on
+        the same channel cancels the previous one if it has not started
+        yet. The image is refreshed by the update schedule once the
+        pipeline changes.
+        '''
+        return self.worker.submit(
+            operation,
+            *args,
+            channel=channel,
+            on_done=on_done,
+            on_error=self.on_pipeline_error,
+        )
+
+    def on_pipeline_error(self, error: Exception):
+        error_popup = ErrorPopup()
+        error_popup.message = str(error)
+        error_popup.open()
+
+    def on_image_layout(self):
+        self.layout_tiles()
+        self.update_contour_transform()
+
     def resize_image(self):
         w, h = self.size
         aspect = self.pipeline.aspect
@@ -166,143 +249,283 @@ class MPLWidget(Widget):
             show_pipeline = self.app.config.get(
                 'General', 'show_pipeline'
             ) == 'ON'
-            image = (
-                self.pipeline.processed
-                if show_pipeline else self.pipeline.original
-            )
 
-            colorfmt = 'luminance' if image.ndim == 2 else 'bgr'
+            self.resize_image()
+            # The worker may be writing over the image buffers, in which
+            # case the upload waits for the next frame
+            if self.pipeline.lock.acquire(blocking=False):
+                try:
+                    self.upload_texture(
+                        'processed' if show_pipeline else 'original'
+                    )
+                finally:
+                    self.pipeline.lock.release()
+
+            self.center_image()
+            self.update_contour_transform()
+
+    def display_level(self, shape: tuple[int]) -> int:
+        '''
+        Pyramid level of an image of the given shape with the lowest
+        resolution that is not below the screen resolution of the image
+        at the current zoom.
+        '''
+        scale = self.image.width * self.scatter.scale / shape[1]
+        if scale <= 0 or scale >= 1:
+            return 0
+        return min(int(np.log2(1 / scale)), int(np.log2(min(shape[:2]))))
+
+    def visible_tiles(self, shape: tuple[int]) -> set[tuple[int]]:
+        '''
+        Rows and columns of the tiles of a displayed image of the given
+        shape that are inside the window.
+        '''
+        if not self.image.width or not self.image.height:
+            return set()
+
+        h, w = shape[:2]
+        (x0, y0), (x1, y1) = (
+            self.image.to_widget(x, y) for x, y in ((0, 0), Window.size)
+        )
+
+        # Window corners in image pixels, rows counted from the top
+        c0, c1 = ((x - self.image.x) / self.image.width * w for x in (x0, x1))
+        r0, r1 = (
+            (self.image.top - y) / self.image.height * h for y in (y1, y0)
+        )
+        rows = range(
+            max(0, int(r0 // tile_size)),
+            min(-(-h // tile_size), int(np.ceil(r1 / tile_size))),
+        )
+        columns = range(
+            max(0, int(c0 // tile_size)),
+            min(-(-w // tile_size), int(np.ceil(c1 / tile_size))),
+        )
+        return {(i, j) for i in rows for j in columns}
+
+    def upload_texture(self, which: str):
+        '''
+        Show the processed or original image at the pyramid level
+        matching the current zoom, as one texture per tile of the level
+        inside the window, so that GPU memory and uploads follow the
+        screen rather than the image. Tiles are uploaded when they come
+        into view and released when they leave it.
+
+        Each tile is uploaded straight from the image rows, the texture
+        reading them with the row length of the image. OpenCV images are
+        stored top row first, so instead of flipping the buffer the
+        textures are flipped vertically.
+        '''
+        level = self.display_level(self.pipeline.original.shape)
+        state = (self.pipeline.version, which, level)
+        image = np.ascontiguousarray(
+            self.pipeline.display_image(which, level)
+        )
 
-            buff = cv.flip(image, 0).tobytes()
-            texture = Texture.create(
-                size=(image.shape[1], image.shape[0]), colorfmt=colorfmt
+        if state != self._texture_state:
+            self.clear_tiles()
+            self._texture_state = state
+            self._tiled_shape = image.shape
+
+        visible = self.visible_tiles(image.shape)
+        for key in self._tiles.keys() - visible:
+            self.tile_group.remove(self._tiles.pop(key))
+
+        new = visible - self._tiles.keys()
+        if not new:
+            return
+
+        h, w = image.shape[:2]
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        colorfmt = 'luminance' if image.ndim == 2 else 'bgr'
+        buffer = image.reshape(-1)
+        for i, j in new:
+            y0, x0 = i * tile_size, j * tile_size
+            size = (min(tile_size, w - x0), min(tile_size, h - y0))
+
+            texture = Texture.create(size=size, colorfmt=colorfmt)
+            texture.flip_vertical()
+            texture.blit_buffer(
+                buffer[(y0 * w + x0) * channels:],
+                size=size,
+                colorfmt=colorfmt,
+                bufferfmt='ubyte',
+                rowlength=w,
             )
-            texture.blit_buffer(buff, colorfmt=colorfmt, bufferfmt='ubyte')
 
-            self.image.texture = texture
+            self._tiles[i, j] = Rectangle(texture=texture)
+            self.tile_group.add(self._tiles[i, j])
+
+        self.layout_tiles()
+
+    def layout_tiles(self):
+        '''Place the tile rectangles over the image widget.'''
+        if self._tiles:
+            h, w = self._tiled_shape[:2]
+            sx, sy = self.image.width / w, self.image.height / h
+            for (i, j), rect in self._tiles.items():
+                tw, th = rect.texture.size
+                rect.pos = (
+                    self.image.x + j * tile_size * sx,
+                    self.image.top - (i * tile_size + th) * sy,
+                )
+                rect.size = (tw * sx, th * sy)
 
-            self.resize_image()
-            self.center_image()
-            self.image.canvas.ask_update()
+    def clear_tiles(self):
+        self.tile_group.clear()
+        self.tile_group.add(Color(1, 1, 1, 1))
+        self._tiles = {}
 
     def center_image(self):
-        if self.image.texture:
-            self.image.pos = (
-                0.5 * (self.width - self.image.width),
-                0.5 * (self.height - self.image.height),
-            )
+        self.image.pos = (
+            0.5 * (self.width - self.image.width),
+            0.5 * (self.height - self.image.height),
+        )
 
     def zoom(self, factor):
         self.scatter.scale *= factor
 
     def clear(self):
+        if self._update_event is not None:
+            self._update_event.cancel()
+            self._update_event = None
+
         self.pipeline.clear('all')
-        self.clear_contour(self.contours.keys())
-        self.image.texture = None
-        self._transform_matrix = None
+        self.clear_contour(self.contour_layer.keys())
+        self.clear_tiles()
+        self._texture_state = None
+        self._calibration = None
 
     @property
-    def transform_matrix(self):
-        if self._transform_matrix is None:
-            ticks = []
-            for j, contour in self.pipeline.contours.items():
-                if not contour.label:
-                    break
-                if contour.label == 'tick':
-                    ticks.append(j)
-
-            if len(ticks) < 3:
+    def calibration(self) -> Calibration | None:
+        '''
+        Map from the image to the user coordinates, fitted to the ticks
+        on first use after the ticks or the log scale change.
+        '''
+        if self._calibration is None:
+            try:
+                with self.pipeline.lock:
+                    self._calibration = Calibration.from_ticks(
+                        self.pipeline.contours,
+                        self.app.config.get('Math', 'log_scale'),
+                    )
+            except ValueError as e:
                 error_popup = ErrorPopup()
-                error_popup.message = (
-                    'At least 3 ticks are required to construct '
-                    'transform matrix'
-                )
+                error_popup.message = str(e)
                 error_popup.open()
-                return
-
-            ek = [random.choice(self.contours[tick].points) for tick in ticks]
-            ek = np.array(ek).T
-            ep = np.array(
-                [self.pipeline.contours[tick].coordinate for tick in ticks]
-            ).T
 
-            # Transformation matrix maps the image coordinates to the user
-            # coordinates
-            self._transform_matrix = affine_map(ek, ep)
-
-        return self._transform_matrix
+        return self._calibration
 
     #---------------------------
     # Contour operations
     #---------------------------
-    def map_cv_contour_to_image(self, contour: int | ContourWidget):
-        '''Map OpenCV contour to widget coordinates.'''
-        w, h = self.image.size
-        x, y = self.image.pos
-
-        scale = (
-            w / self.pipeline.original.shape[1],
-            h / self.pipeline.original.shape[0],
-        )
+    def contour_at(self, x: float, y: float) -> int | None:
+        '''Key of the drawn contour closest to the point, if any.'''
+        return self.contour_layer.contour_at(x, y, self.collide_threshold)
 
-        if isinstance(contour, int):
-            contour = self.pipeline.contours.get(contour)
+    def update_contour_transform(self):
+        '''Map OpenCV image pixels onto the displayed image.'''
+        if not self.pipeline.isempty:
+            w, h = self.image.size
+            x, y = self.image.pos
+            shape = self.pipeline.original.shape
 
-        return [
-            (x + p[0][0] * scale[0], y + h - p[0][1] * scale[1])
-            for p in contour.points
-        ]
+            self.contour_layer.set_transform(
+                (x, y + h), (w / shape[1], h / shape[0])
+            )
 
-    def map_image_contour_to_user(self, key: int):
-        x = np.array(self.contours[key].points).T
-        x = np.concatenate([x, np.ones([1, x.shape[1]])], axis=0)
-        return self.transform_matrix @ x
+    def map_image_to_user(self, points: np.ndarray) -> np.ndarray | None:
+        '''Map image points, shape (n, 2), to the user coordinates.'''
+        calibration = self.calibration
+        if calibration is None:
+            return None
+        return calibration.to_user(points)
 
     def draw_contours(
         self, color='blue', redraw=False, contours: set[int] | None = None
     ):
-        '''Draw OpenCV contours as widgets'''
+        '''
+        Draw OpenCV contours on the contour layer. The contours are found
+        if needed and their points read in the background, as the worker
+        may be replacing the contours meanwhile.
+        '''
+        if not self.pipeline.isempty:
+            self.run_pipeline(
+                self.find_contours,
+                channel='contours',
+                on_done=lambda points: self.
+                draw_found_contours(points, color, redraw, contours),
+            )
+
+    def find_contours(self) -> dict[int, np.ndarray]:
+        '''Points of all contours, edges and contours found if needed.'''
         p = self.pipeline
 
-        if not p.isempty:
+        with p.lock:
+            if p.isempty:
+                return {}
             if not p.isedgy:
                 p.edges()
             if not p.contours:
                 p.find_contours()
+            return {k: p.contours.points(k) for k in p.contours}
+
+    def draw_found_contours(
+        self,
+        points: dict[int, np.ndarray],
+        color='blue',
+        redraw=False,
+        contours: set[int] | None = None,
+    ):
+        '''Draw the contours not drawn yet given their points.'''
+        if redraw:
+            self.clear_contour(
+                contours if contours is not None else points.keys(),
+                reindex=False,
+            )
 
-            contours = contours if contours is not None else p.contours.keys()
+        for k, contour in points.items():
+            if k not in self.contour_layer:
+                self.contour_layer.add(k, contour, color)
 
-            if redraw:
-                self.clear_contour(contours)
+        self.contour_layer.reindex()
 
-            for k in p.contours:
-                if k not in self.contours:
-                    contour = ContourWidget(
-                        k, self.map_cv_contour_to_image(p.contours[k]), color
-                    )
-                    self.image.add_widget(contour)
-                    self.contours[k] = contour
+    def replace_contour(self, old: int, new: dict[int, np.ndarray]):
+        if old in self.contour_layer:
+            self.clear_contour({old}, reindex=False)
 
-    def replace_contour(self, old: int, new: dict):
-        if old in self.contours:
-            self.clear_contour({old})
+            for k, points in new.items():
+                self.contour_layer.add(k, points)
 
-            for k in new:
-                contour = ContourWidget(k, self.map_cv_contour_to_image(k))
-                self.image.add_widget(contour)
-                self.contours[k] = contour
+            self.contour_layer.reindex()
 
     def split_contour(self, key: int):
-        contour = self.pipeline.contours.get(key)
-        if contour is None:  # Shouldn't happen
-            raise RuntimeError('Contour not found')
+        self.run_pipeline(
+            self._split_contour,
+            key,
+            on_done=lambda result: self.on_contour_split(key, *result),
+        )
+
+    def _split_contour(self, key: int) -> tuple[bool, dict]:
+        '''
+        Split a contour in the background. Returns whether it was a tick
+        and the points of the new contours.
+        '''
+        p = self.pipeline
 
-        subkeys = self.pipeline.split_contour(key)
+        with p.lock:
+            contour = p.contours.get(key)
+            if contour is None:
+                raise ValueError(f'Contour {key} not found')
 
-        self.replace_contour(
-            key, {k: self.pipeline.contours[k]
-                  for k in subkeys}
-        )
+            tick = contour.label == 'tick'
+            subkeys = p.split_contour(key)
+            return tick, {k: p.contours.points(k) for k in subkeys}
+
+    def on_contour_split(self, key: int, tick: bool, new: dict):
+        if tick:
+            self._calibration = None
+        self.replace_contour(key, new)
 
     def label_contour(
         self,
@@ -310,40 +533,74 @@ class MPLWidget(Widget):
         label: str | None = None,
         coordinate: str | None = None,
     ):
-        if key not in self.pipeline.contours:  # Shouldn't happen
-            raise RuntimeError('Contour not found')
-
         Logger.debug(f'Labeling contour {key} as {label} at {coordinate}')
 
-        if label is not None:
-            self.pipeline.contours[key].label = label
-        if coordinate is not None:
-            self.pipeline.contours[key].coordinate = coordinate
-
-        # Labeled contours are stored at the beginning to then quickly
-        # locate them
-        self.pipeline.contours.move_to_end(key, last=False)
+        self.run_pipeline(
+            self._label_contour,
+            key,
+            label,
+            coordinate,
+            on_done=lambda tick: self.on_contour_labeled(key, tick),
+        )
 
+    def _label_contour(
+        self, key: int, label: str | None, coordinate: str | None
+    ) -> bool:
+        '''
+        Label a contour in the background. Returns whether ticks changed.
+        '''
+        with self.pipeline.lock:
+            contour = self.pipeline.contours.get(key)
+            if contour is None:
+                raise ValueError(f'Contour {key} not found')
+
+            tick = 'tick' in (label, contour.label)
+            if label is not None:
+                contour.label = label
+            if coordinate is not None:
+                contour.coordinate = coordinate
+            return tick
+
+    def on_contour_labeled(self, key: int, tick: bool):
+        if tick:
+            self._calibration = None  # Ticks change
         self.draw_contours(color='red', redraw=True, contours={key})
 
     def write_contour(self, filename: str):
-        with open(filename, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(['x', 'y'])
-
-            for key in self.marked_contours:
-                Logger.debug(f'Exporting contour {key}')
+        '''
+        Export all marked contours at once: their image points are mapped
+        to the user coordinates in a single transform and streamed to
+        the file in the format given by its extension.
+        '''
+        keys = sorted(self.marked_contours)
+        Logger.debug(f'Exporting contours {keys}')
+
+        with self.pipeline.lock:
+            points = [
+                self.pipeline.contours.points(k).reshape(-1, 2) for k in keys
+            ]
+        offsets = np.cumsum([0] + [len(p) for p in points])
 
-                points = self.map_image_contour_to_user(key)
-                writer.writerows(points.T)
+        points = self.map_image_to_user(
+            np.concatenate(points) if points else np.empty([0, 2])
+        )
+        if points is None:  # Not enough ticks to calibrate
+            return
 
+        export_points(filename, keys, points, offsets)
         self.marked_contours.clear()
 
-    def clear_contour(self, keys: set[int]):
-        for key in list(keys):
-            self.image.remove_widget(self.contours[key])
-            self.contours.pop(key)
-            self.marked_contours.discard(key)
+    def clear_contour(self, keys: set[int], reindex: bool = True):
+        '''
+        Remove drawn contours. The spatial index is rebuilt unless
+        contours are about to be drawn, which rebuilds it anyway.
+        '''
+        keys = list(keys)
+        self.contour_layer.remove(keys)
+        self.marked_contours.difference_update(keys)
+
+        if reindex:
+            self.contour_layer.reindex()
 
 
 class MPLApp(App):
@@ -353,9 +610,20 @@ class MPLApp(App):
         Window.minimum_width = self.config.getint('Graphics', 'min_width')
         Window.minimum_height = self.config.getint('Graphics', 'min_height')
 
+        load_kv()
         self.root_widget = MPLWidget(app=self)
         return self.root_widget
 
+    def on_stop(self):
+        self.root_widget.worker.shutdown()
+
+    def on_config_change(self, config, section, key, value):
+        match (section, key):
+            case ('Advanced', 'contour_collide_threshold'):
+                self.root_widget.collide_threshold = float(value)
+            case ('Math', 'log_scale'):
+                self.root_widget._calibration = None
+
     def build_config(self, config):
         config.adddefaultsection('Math')
         config.setdefault('Math', 'log_scale', 'OFF')
@@ -0,0 +1,224 @@
+'''
+Headless batch digitization of chart images.
+
+Runs the Pipeline chain load_image (at the --size preset) -> gray ->
+blur -> edges -> find_contours on every image of a directory or glob
+pattern and writes the contours of each image to an .npz file named
+after the image, e.g. scans/a/scan.png to contours/a/scan.png.npz.
+Images are processed in a pool of worker processes, or of threads with
+--threads, OpenCV releasing the GIL.
+
+    python batch.py scans/ -o contours/ --size fhd --blur 1
+
+process_all runs the chain on a thread pool within the calling process
+and returns the pipelines.
+'''
+import os
+import sys
+import glob
+import time
+import argparse
+import functools
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+    FIRST_COMPLETED,
+)
+import numpy as np
+
+from pipeline import Pipeline, supported_exts, sizes
+from contours import ContourStore
+
+
+def collect_files(source: str) -> list[str]:
+    '''List supported images in a directory or matching a glob pattern.'''
+    if os.path.isdir(source):
+        source = os.path.join(source, '*')
+
+    return sorted(
+        f for f in glob.glob(source)
+        if os.path.splitext(f)[1].lower() in supported_exts
+    )
+
+
+def output_paths(files: list[str], output: str) -> list[str]:
+    '''
+    .npz file of each image in the output directory. The path of the
+    image relative to the directory common to all images is kept with its
+    extension, so that e.g. scan.png and scan.jpg do not overwrite each
+    other.
+    '''
+    files = [os.path.abspath(f) for f in files]
+    root = os.path.commonpath([os.path.dirname(f) for f in files])
+    return [
+        os.path.join(output, os.path.relpath(f, root) + '.npz') for f in files
+    ]
+
+
+def write_contours(filename: str, contours: ContourStore):
+    '''
+    Write contours to an .npz file as one concatenated array of points
+    and an array of offsets, contour i being
+    points[offsets[i]:offsets[i + 1]].
+    '''
+    keys, points, offsets = contours.to_arrays()
+    np.savez(filename, keys=keys, points=points, offsets=offsets)
+
+
+def process(
+    filename: str,
+    size: str | None = None,
+    blur: int = 1,
+    edges: str = 'canny',
+    external: bool = False,
+) -> Pipeline:
+    '''Run the pipeline chain on one image.'''
+    pipeline = Pipeline()
+    pipeline.load_image(filename, size)
+    pipeline.gray()
+    if blur > 0:
+        pipeline.blur('gaussian', blur)
+    pipeline.edges(edges)
+    pipeline.find_contours(external=external)
+    return pipeline
+
+
+def process_all(
+    files: list[str],
+    workers: int | None = None,
+    **options,
+) -> list[Pipeline]:
+    '''
+    Run the pipeline chain on images in a pool of threads, each image
+    having its own pipeline. Returns the pipelines in the order of the
+    files, the first error being raised.
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(
+            executor.map(functools.partial(process, **options), files)
+        )
+
+
+def digitize(filename: str, destination: str, **options) -> dict:
+    '''
+    Run the pipeline chain on one image and save its contours to the
+    destination .npz file. Errors are reported in the returned summary
+    instead of being raised, so that one broken file does not stop the
+    batch.
+    '''
+    try:
+        pipeline = process(filename, **options)
+
+        os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+        write_contours(destination, pipeline.contours)
+    except Exception as e:
+        return {'file': filename, 'error': f'{type(e).__name__}: {e}'}
+
+    return {
+        'file': filename, 'contours': len(pipeline.contours), 'error': None
+    }
+
+
+def run(
+    files: list[str],
+    output: str,
+    workers: int | None = None,
+    threads: bool = False,
+    **options,
+) -> list[dict]:
+    '''
+    Digitize files in a process pool, or a thread pool if threads, into
+    the output directory, see output_paths. At most two tasks per worker
+    are in flight at any time, which bounds the memory held by pending
+    results.
+    '''
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(output, exist_ok=True)
+
+    results, pending = [], set()
+    queue = iter(zip(files, output_paths(files, output)))
+
+    pool = ThreadPoolExecutor if threads else ProcessPoolExecutor
+    with pool(max_workers=workers) as executor:
+        while True:
+            for filename, destination in queue:
+                pending.add(
+                    executor.submit(
+                        digitize, filename, destination, **options
+                    )
+                )
+                if len(pending) >= 2 * workers:
+                    break
+
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            results.extend(f.result() for f in done)
+
+    return results
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Digitize chart images without the GUI.'
+    )
+    parser.add_argument('source', help='Directory or glob pattern of images')
+    parser.add_argument(
+        '-o', '--output', default='contours', help='Output directory'
+    )
+    parser.add_argument('--size', choices=sizes, help='Resize preset')
+    parser.add_argument(
+        '--blur',
+        type=int,
+        default=1,
+        help='Gaussian blur level, 0 to skip blurring'
+    )
+    parser.add_argument('--edges', default='canny', help='Edge detector')
+    parser.add_argument(
+        '--external',
+        action='store_true',
+        help='Only find the outermost contours'
+    )
+    parser.add_argument(
+        '-j', '--workers', type=int, help='Number of worker processes'
+    )
+    parser.add_argument(
+        '--threads',
+        action='store_true',
+        help='Use worker threads instead of processes'
+    )
+    args = parser.parse_args(argv)
+
+    files = collect_files(args.source)
+    if not files:
+        print(f'No supported images found in {args.source}', file=sys.stderr)
+        return 1
+
+    start = time.perf_counter()
+    results = run(
+        files,
+        args.output,
+        workers=args.workers,
+        threads=args.threads,
+        size=args.size,
+        blur=args.blur,
+        edges=args.edges,
+        external=args.external,
+    )
+    elapsed = time.perf_counter() - start
+
+    failed = [r for r in results if r['error'] is not None]
+    for r in failed:
+        print(f'{r["file"]}: {r["error"]}', file=sys.stderr)
+
+    print(
+        f'Processed {len(results) - len(failed)}/{len(results)} images in '
+        f'{elapsed:.2f} s ({len(results) / elapsed:.2f} images/s)'
+    )
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+import numpy as np
+
+from metrics import affine_map
+
+log_scales = ('OFF', 'X', 'Y', 'XY')
+
+
+class Calibration:
+    '''
+    Maps image pixel coordinates to the user coordinates of the plot and
+    back. The map is the least-squares affine fit of the tick points to
+    their user coordinates, the coordinates along logarithmic axes being
+    fitted by their decimal logarithm. Both the forward and the inverse
+    transforms are computed once, and each maps any number of points in
+    one vectorized call.
+    '''
+
+    def __init__(
+        self,
+        image_points: np.ndarray,
+        user_points: np.ndarray,
+        log_scale: str = 'OFF',
+    ):
+        '''
+        Parameters
+        ----------
+        image_points : np.ndarray
+            Image coordinates of the ticks, shape (n, 2), n >= 3.
+        user_points : np.ndarray
+            User coordinates of the ticks, shape (n, 2).
+        log_scale : str
+            Logarithmic axes, one of 'OFF', 'X', 'Y' and 'XY'.
+
+        Raises
+        ------
+        ValueError
+            If there are less than 3 ticks, the ticks are collinear or a
+            tick is not positive along a logarithmic axis.
+        '''
+        if log_scale not in log_scales:
+            raise ValueError(f'Bad log scale: {log_scale}')
+
+        image_points = np.asarray(image_points, dtype=float).reshape(-1, 2)
+        user_points = np.asarray(user_points, dtype=float).reshape(-1, 2)
+        if len(image_points) < 3:
+            raise ValueError(
+                'At least 3 ticks are required to construct '
+                'transform matrix'
+            )
+
+        self.log_scale = log_scale
+        self.log_axes = [i for i, axis in enumerate('XY') if axis in log_scale]
+        if (user_points[:, self.log_axes] <= 0).any():
+            raise ValueError('Ticks must be positive along logarithmic axes')
+
+        user_points = user_points.copy()
+        user_points[:, self.log_axes] = np.log10(
+            user_points[:, self.log_axes]
+        )
+
+        try:
+            self.forward = affine_map(image_points.T, user_points.T)
+        except ValueError as e:
+            raise ValueError('Ticks must not be collinear') from e
+
+        A, b = self.forward[:, :2], self.forward[:, 2]
+        A_inv = np.linalg.inv(A)
+        self.inverse = np.concatenate([A_inv, -A_inv @ b[:, None]], axis=1)
+
+    @classmethod
+    def from_ticks(cls, contours, log_scale: str = 'OFF'):
+        '''
+        Calibrate from the contours labeled as ticks in a ContourStore,
+        each tick being located at the centroid of its points.
+        '''
+        ticks = contours.where(label='tick').tolist()
+        image_points = [
+            contours.points(k).reshape(-1, 2).mean(axis=0) for k in ticks
+        ]
+        user_points = [contours[k].coordinate for k in ticks]
+        if any(c is None for c in user_points):
+            raise ValueError('Every tick needs a coordinate')
+
+        return cls(image_points, user_points, log_scale)
+
+    def to_user(self, points: np.ndarray) -> np.ndarray:
+        '''Map image points, shape (n, 2), to the user coordinates.'''
+        result = np.asarray(points, dtype=float).reshape(-1, 2)
+        result = result @ self.forward[:, :2].T
+        result += self.forward[:, 2]
+        for i in self.log_axes:
+            np.power(10.0, result[:, i], out=result[:, i])
+        return result
+
+    def to_image(self, points: np.ndarray) -> np.ndarray:
+        '''Map user points, shape (n, 2), to the image coordinates.'''
+        result = np.array(points, dtype=float).reshape(-1, 2)
+        for i in self.log_axes:
+            np.log10(result[:, i], out=result[:, i])
+        result = result @ self.inverse[:, :2].T
+        result += self.inverse[:, 2]
+        return result
@@ -1,5 +1,5 @@
 import os.path
-import matplotlib.colors as colors
+import numpy as np
 
 from kivy.app import App
 from kivy.lang import Builder
@@ -10,12 +10,48 @@ from kivy.uix.popup import Popup
 from kivy.uix.button import Button
 from kivy.uix.scatter import Scatter
 from kivy.uix.dropdown import DropDown
-from kivy.graphics import Color, Line
+from kivy.graphics import (
+    Color,
+    Line,
+    InstructionGroup,
+    PushMatrix,
+    PopMatrix,
+    Translate,
+    Scale,
+)
 from kivy.properties import ObjectProperty, StringProperty
+from kivy.utils import colormap, get_color_from_hex
 
-from metrics import point_segment_distance
+from spatial import SegmentIndex
 
-Builder.load_file('components.kv')
+_kv_loaded = False
+
+
+def load_kv():
+    '''
+    Load the rules of the components. Called by the app once the window
+    is being built rather than at import time.
+    '''
+    global _kv_loaded
+    if not _kv_loaded:
+        Builder.load_file('components.kv')
+        _kv_loaded = True
+
+
+def to_rgba(color: str | tuple) -> tuple[float]:
+    '''RGBA tuple of a color name, hex string or RGB(A) tuple.'''
+    if isinstance(color, str):
+        if color.startswith('#'):
+            rgba = get_color_from_hex(color)
+        elif color.lower() in colormap:
+            rgba = colormap[color.lower()]
+        else:
+            raise ValueError(f'Invalid color: {color}')
+    else:
+        rgba = color
+
+    rgba = tuple(float(c) for c in rgba)
+    return rgba if len(rgba) == 4 else rgba + (1.0, )
 
 
 def print_widget_hierarchy(widget, level=0):
@@ -123,7 +159,10 @@ class BaseDropDown(DropDown):
 
     def open(self, widget, pos):
         super().open(widget)
+        self.move_to(pos)
 
+    def move_to(self, pos):
+        '''Place the dropdown at a window position, kept in the window.'''
         x, y = pos
 
         if x + self.width > Window.width:
@@ -140,12 +179,14 @@ class BaseDropDown(DropDown):
 class ToolsDropDown(DropDown):
     blur_dropdown = ObjectProperty()
     detect_edges_dropdown = ObjectProperty()
+    threshold_dropdown = ObjectProperty()
     open_nested_dropdown = staticmethod(open_nested_dropdown)
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.blur_dropdown = Factory.BlurDropDown()
         self.detect_edges_dropdown = Factory.DetectEdgesDropDown()
+        self.threshold_dropdown = Factory.ThresholdDropDown()
 
 
 class MathDropDown(DropDown):
@@ -166,56 +207,42 @@ class LogScaleDropDown(DropDown):
         self.bind(on_select=self.update)
 
     def open(self, *args):
+        # The settings panel may have changed the scale since last time
+        self.selection = App.get_running_app().config.get('Math', 'log_scale')
         for child in self.container.children:
             child.state = 'down' if child.text == self.selection else 'normal'
         super().open(*args)
 
     def update(self, instance, value):
         self.selection = value
-
-        app = App.get_running_app()
-        app.config.set('Math', 'log_scale', value)
-        app.config.write()
+        App.get_running_app().root_widget.on_log_scale_select(value)
 
 
 class ContourDropDown(BaseDropDown):
-    label_axis_dropdown = ObjectProperty()
-    open_nested_dropdown = staticmethod(open_nested_dropdown)
-
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.label_axis_dropdown = Factory.LabelAxisDropDown()
-
-
-class ContourWidget(Widget):
     '''
-    Handles the logic of interactable contours. Stores the unique key
-    of the contour to identify it in the pipeline.
+    Actions on a contour, identified by its unique key in the pipeline.
+    The actions are delegated to MPLWidget. A single dropdown is shared
+    by all contours and retargeted by setting the key before opening.
     '''
+    label_axis_dropdown = ObjectProperty()
+    open_nested_dropdown = staticmethod(open_nested_dropdown)
 
-    def __init__(self, key, points, color='blue', **kwargs):
+    def __init__(self, key=None, **kwargs):
         super().__init__(**kwargs)
-
-        self._hovered = False
         self.key = key
-        self.color = colors.to_rgba(color)
-
-        self.update(points)
-
-        self.contour_dropdown = ContourDropDown()
+        self.label_axis_dropdown = Factory.LabelAxisDropDown()
 
-        # Delegate contour actions to MPLWidget
         root_widget = App.get_running_app().root_widget
         actions = {
             'Split':
             lambda instance: root_widget.split_contour(self.key),
             'Clear':
-            lambda instance: root_widget.clear_contour(self.key),
+            lambda instance: root_widget.clear_contour({self.key}),
             'Label as...':
-            lambda instance: self.contour_dropdown.open_nested_dropdown(
-                self.contour_dropdown.label_axis_dropdown,
+            lambda instance: self.open_nested_dropdown(
+                self.label_axis_dropdown,
                 instance,
-                self.contour_dropdown,
+                self,
             ),
             'Export...':
             self.on_export_button_press,
@@ -224,54 +251,11 @@ class ContourWidget(Widget):
             button = Button(text=action, height=50, size_hint_y=None)
 
             button.bind(on_press=callback)
-            button.bind(on_release=self.contour_dropdown.dismiss)
-
-            self.contour_dropdown.add_widget(button)
-
-        self.contour_dropdown.label_axis_dropdown.bind(
-            on_select=self.on_label_button_press
-        )
-
-    @property
-    def hovered(self):
-        return self._hovered
-
-    @hovered.setter
-    def hovered(self, value):
-        if self.hovered != value:
-            self._hovered = value
-            self.update(self.points)
-
-    def update(self, points):
-        self.points = points
-
-        self.canvas.clear()
-        with self.canvas:
-            if self.hovered:
-                Color(0, 1, 0, 1)
-            else:
-                Color(*self.color)
+            button.bind(on_release=self.dismiss)
 
-            Line(points=sum(points, ()), width=2)
+            self.add_widget(button)
 
-    def collide_point(self, x, y, threshold=10):
-        '''
-        For better detection of collisions when contour's points are far
-        apart, we calculate the distance from the point to each segment
-        of the contour.
-        '''
-        for i in range(len(self.points) - 1):
-            if point_segment_distance(
-                (x, y), (self.points[i], self.points[i + 1])
-            ) < threshold:
-                return True
-        return False
-
-    def on_touch_down(self, touch):
-        if touch.button == 'left' and self.collide_point(*touch.pos):
-            self.contour_dropdown.open(self, touch.pos)
-            return True
-        return super().on_touch_down(touch)
+        self.label_axis_dropdown.bind(on_select=self.on_label_button_press)
 
     def on_label_button_press(self, instance, value):
         root_widget = App.get_running_app().root_widget
@@ -291,3 +275,127 @@ class ContourWidget(Widget):
         root_widget.marked_contours.add(self.key)
 
         root_widget.file_saver.open()
+
+
+class ContourLayer(Widget):
+    '''
+    Draws all contours on the canvas of a single widget. Every contour is
+    a Color and a Line instruction in its own group, so that hovering
+    and selection only change the Color of the affected contours. Keeps
+    a spatial index of the drawn contours for hit-testing.
+
+    Contours are drawn and indexed in image pixel coordinates, and mapped
+    to widget coordinates by a transform on the canvas, so resizing only
+    updates the transform.
+    '''
+    hover_color = (0, 1, 0, 1)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        self.points = {}  # Image coordinates of each drawn contour
+        self.index = SegmentIndex({})
+        self._colors = {}
+        self._groups = {}
+        self._hovered = None
+        self._dropdown = None
+
+        # Image pixel (px, py) is drawn at (ox + px * sx, oy - py * sy)
+        self._transform = (0.0, 0.0, 1.0, 1.0)
+        with self.canvas.before:
+            PushMatrix()
+            self._translate = Translate(0, 0)
+            self._scale = Scale(1, -1, 1)
+        with self.canvas.after:
+            PopMatrix()
+
+    def __contains__(self, key):
+        return key in self.points
+
+    def keys(self):
+        return list(self.points)
+
+    @property
+    def hovered(self):
+        return self._hovered
+
+    @hovered.setter
+    def hovered(self, key):
+        if key != self._hovered:
+            if self._hovered in self._colors:
+                color, rgba = self._colors[self._hovered]
+                color.rgba = rgba
+            if key in self._colors:
+                self._colors[key][0].rgba = self.hover_color
+            self._hovered = key
+
+    def set_transform(self, origin: tuple[float], scale: tuple[float]):
+        '''
+        Map image pixels to widget coordinates, origin being the widget
+        position of the top left corner of the image and scale the
+        widget size of one pixel.
+        '''
+        transform = (*origin, *scale)
+        if transform != self._transform:
+            self._transform = transform
+            self._translate.xy = origin
+            self._scale.x, self._scale.y = scale[0], -scale[1]
+
+    def to_image(self, x: float, y: float) -> tuple[float]:
+        '''Image coordinates of a point in widget coordinates.'''
+        ox, oy, sx, sy = self._transform
+        return (x - ox) / sx, (oy - y) / sy
+
+    def add(self, key: int, points: np.ndarray, color='blue'):
+        '''Draw a contour given its points in image coordinates.'''
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        rgba = to_rgba(color)
+
+        group = InstructionGroup()
+        instruction = Color(*rgba)
+        group.add(instruction)
+        group.add(Line(points=points.ravel().tolist()))
+        self.canvas.add(group)
+
+        self.points[key] = points
+        self._colors[key] = (instruction, rgba)
+        self._groups[key] = group
+
+    def remove(self, keys: set[int]):
+        for key in list(keys):
+            self.canvas.remove(self._groups.pop(key))
+            self.points.pop(key)
+            self._colors.pop(key)
+            if key == self._hovered:
+                self._hovered = None
+
+    @property
+    def dropdown(self) -> ContourDropDown:
+        '''Contour actions dropdown, created on first use.'''
+        if self._dropdown is None:
+            self._dropdown = ContourDropDown()
+        return self._dropdown
+
+    def open_dropdown(self, key: int, pos: tuple[float]):
+        dropdown = self.dropdown
+        dropdown.key = key
+        if dropdown.attach_to is self:
+            # Still shown for the previous contour, so move it instead of
+            # opening it twice
+            dropdown.move_to(pos)
+        else:
+            dropdown.open(self, pos)
+
+    def reindex(self):
+        '''Rebuild the spatial index after drawn contours change.'''
+        self.index = SegmentIndex(self.points)
+
+    def contour_at(self, x: float, y: float, threshold: float) -> int | None:
+        '''
+        Key of the drawn contour closest to the point in widget
+        coordinates, if any.
+        '''
+        sx, sy = self._transform[2:]
+        return self.index.nearest(
+            *self.to_image(x, y), threshold / min(sx, sy)
+        )
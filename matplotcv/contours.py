@@ -0,0 +1,460 @@
+import hashlib
+import numpy as np
+
+from utils import standard_coordinate
+
+
+def contour_hash(points: np.ndarray) -> bytes:
+    '''Hash of the contour point buffer, independent of its shape.'''
+    points = np.ascontiguousarray(points, dtype=np.int32).reshape(-1, 2)
+    return hashlib.blake2b(points.tobytes(), digest_size=16).digest()
+
+
+def _grow(a: np.ndarray, n: int, fill=0) -> np.ndarray:
+    '''Copy of the array with room for at least n rows.'''
+    shape = (max(n, 2 * len(a)), ) + a.shape[1:]
+    grown = np.full(shape, fill, dtype=a.dtype)
+    grown[:len(a)] = a
+    return grown
+
+
+class Contour:
+    '''
+    View of one contour stored in a ContourStore. Reading and setting
+    attributes goes straight to the arrays of the store.
+    '''
+    __slots__ = ('store', 'key')
+
+    def __init__(self, store, key: int):
+        self.store = store
+        self.key = key
+
+    @property
+    def _row(self):
+        return self.store._rows[self.key]
+
+    @property
+    def points(self) -> np.ndarray:
+        '''Contour points, shape (n, 1, 2), a view of the point buffer.'''
+        return self.store.points(self.key)
+
+    @property
+    def label(self) -> str:
+        return self.store.label_names[self.store._labels[self._row]]
+
+    @label.setter
+    def label(self, value: str):
+        self.store._labels[self._row] = self.store.label_code(value)
+
+    @property
+    def coordinate(self):
+        coordinate = self.store._coordinates[self._row]
+        if np.isnan(coordinate).any():
+            return None
+        return tuple(float(v) for v in coordinate)
+
+    @coordinate.setter
+    def coordinate(self, value: str):
+        try:
+            x, y = value.split(',')
+            self.store._coordinates[self._row] = (
+                standard_coordinate(x), standard_coordinate(y)
+            )
+        except Exception as e:
+            raise ValueError(f'Invalid coordinate format: {value}') from e
+
+        print(f'Coordinate set to {self.coordinate}')
+
+    @property
+    def closed(self) -> bool:
+        return bool(self.store._closed[self._row])
+
+    @closed.setter
+    def closed(self, value: bool):
+        self.store._closed[self._row] = value
+
+    @property
+    def roi(self):
+        roi = self.store._rois[self._row]
+        return None if roi[0] < 0 else tuple(int(v) for v in roi)
+
+    @roi.setter
+    def roi(self, value: tuple | None):
+        if value is None:
+            value = (-1, -1, -1, -1)
+        self.store._rois[self._row] = value
+
+    @property
+    def parent(self) -> int | None:
+        parent = self.store._parents[self._row]
+        return None if parent < 0 else int(parent)
+
+    @property
+    def children(self) -> set[int]:
+        return set(self.store.children(self.key))
+
+
+class ContourStore:
+    '''
+    Contours stored as a struct of arrays: the points of all contours are
+    concatenated in one buffer, contour i spanning
+    points[offsets[i]:offsets[i + 1]], and the attributes of contours are
+    stored in one array each. Removed contours are only marked dead and
+    the arrays are compacted once most rows are dead.
+
+    The nesting of contours is kept as a tree in the layout of the
+    hierarchy returned by cv.findContours: the parent, first child and
+    next sibling of each contour, all given by key, -1 standing for none.
+    The tree is maintained when contours are added and removed.
+
+    Keeps the mapping interface of the dict of contours it replaces, with
+    contours accessed by their unique key, and adds vectorized queries
+    over all contours.
+    '''
+
+    def __init__(
+        self,
+        contours: list[np.ndarray] = (),
+        hierarchy: np.ndarray | None = None,
+    ):
+        '''
+        Store contours, with their hierarchy as returned by
+        cv.findContours with RETR_TREE if given.
+        '''
+        self._points = np.empty([0, 2], dtype=np.int32)
+        self._npoints = 0
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._keys = np.empty(0, dtype=np.int64)
+        self._labels = np.empty(0, dtype=np.int8)
+        self._coordinates = np.empty([0, 2])
+        self._rois = np.empty([0, 4], dtype=np.int64)
+        self._parents = np.empty(0, dtype=np.int64)
+        self._first_children = np.empty(0, dtype=np.int64)
+        self._next_siblings = np.empty(0, dtype=np.int64)
+        self._closed = np.empty(0, dtype=bool)
+        self._alive = np.empty(0, dtype=bool)
+        self._n = 0  # Number of used rows, dead rows included
+
+        self._rows = {}  # Row of each key
+        self._hashes = {}  # Keys of the contours of each point buffer hash
+        self._next_key = 0
+        self.label_names = ['', 'x', 'y', 'tick']
+
+        # Whether the tree holds the full nesting of the contours, so that
+        # children need not be searched in the image
+        self.tree = hierarchy is not None
+        self.extend(contours, hierarchy=hierarchy)
+
+    #---------------------------
+    # Mapping interface
+    #---------------------------
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __iter__(self):
+        return iter(self.keys_array().tolist())
+
+    def __getitem__(self, key) -> Contour:
+        if key not in self._rows:
+            raise KeyError(key)
+        return Contour(self, key)
+
+    def get(self, key, default=None):
+        return Contour(self, key) if key in self._rows else default
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [Contour(self, k) for k in self]
+
+    def items(self):
+        return [(k, Contour(self, k)) for k in self]
+
+    #---------------------------
+    # Modification
+    #---------------------------
+    def extend(
+        self,
+        contours: list[np.ndarray],
+        parent: int = -1,
+        hierarchy: np.ndarray | None = None,
+    ):
+        '''
+        Store new contours and return their unique keys. The contours are
+        nested in the tree as given by their hierarchy, as returned by
+        cv.findContours, or else as children of the parent, if any.
+        '''
+        if not len(contours):
+            return []
+
+        n = len(contours)
+        lengths = np.fromiter(map(len, contours), dtype=np.int64, count=n)
+        rows = slice(self._n, self._n + n)
+
+        try:  # OpenCV contours all have shape (m, 1, 2)
+            points = np.concatenate(contours).reshape(-1, 2)
+        except ValueError:
+            points = np.concatenate([np.reshape(c, (-1, 2)) for c in contours])
+
+        if self._n + n > len(self._keys):
+            size = self._n + n
+            self._keys = _grow(self._keys, size)
+            self._labels = _grow(self._labels, size)
+            self._coordinates = _grow(self._coordinates, size)
+            self._rois = _grow(self._rois, size)
+            self._parents = _grow(self._parents, size)
+            self._first_children = _grow(self._first_children, size)
+            self._next_siblings = _grow(self._next_siblings, size)
+            self._closed = _grow(self._closed, size)
+            self._alive = _grow(self._alive, size)
+            self._offsets = _grow(self._offsets, size + 1)
+
+        npoints = self._npoints + lengths.sum()
+        if npoints > len(self._points):
+            self._points = _grow(self._points, npoints)
+        self._points[self._npoints:npoints] = points
+
+        keys = np.arange(self._next_key, self._next_key + n)
+        self._keys[rows] = keys
+        self._labels[rows] = 0
+        self._coordinates[rows] = np.nan
+        self._rois[rows] = -1
+        self._closed[rows] = False
+
+        if hierarchy is not None:
+            # Columns are next, previous, first child and parent indices
+            hierarchy = np.reshape(hierarchy, (n, 4))
+            tree = np.where(hierarchy < 0, -1, hierarchy + self._next_key)
+            self._next_siblings[rows] = tree[:, 0]
+            self._first_children[rows] = tree[:, 2]
+            self._parents[rows] = tree[:, 3]
+        else:
+            # Chained as siblings, in front of the children of the parent
+            self._next_siblings[rows] = keys + 1
+            self._next_siblings[self._n + n - 1] = (
+                self._first_children[self._rows[parent]]
+                if parent >= 0 else -1
+            )
+            self._first_children[rows] = -1
+            self._parents[rows] = parent
+            if parent >= 0:
+                self._first_children[self._rows[parent]] = keys[0]
+        self._alive[rows] = True
+        self._offsets[self._n + 1:self._n + n + 1] = (
+            self._npoints + np.cumsum(lengths)
+        )
+
+        # Hash the contours straight from the bytes of the point buffer,
+        # 8 bytes per point
+        data = memoryview(self._points[self._npoints:npoints]).cast('B')
+        bounds = (8 * np.concatenate([[0], np.cumsum(lengths)])).tolist()
+
+        keys = keys.tolist()
+        for i, key in enumerate(keys):
+            self._rows[key] = self._n + i
+            h = hashlib.blake2b(data[bounds[i]:bounds[i + 1]], digest_size=16)
+            self._hashes.setdefault(h.digest(), []).append(key)
+
+        self._n += n
+        self._npoints = npoints
+        self._next_key += n
+        return keys
+
+    def add(self, points: np.ndarray, parent: int = -1) -> int:
+        '''Store a new contour and return its unique key.'''
+        return self.extend([points], parent)[0]
+
+    def pop(self, key: int) -> np.ndarray:
+        '''
+        Remove a contour and return its points. Its children take its
+        place among the children of its parent.
+        '''
+        points = self.points(key)
+        children = self.children(key)
+
+        row = self._rows[key]
+        if children:
+            for child in children:
+                self._parents[self._rows[child]] = self._parents[row]
+            self._replace_link(key, children[0])
+            self._next_siblings[self._rows[children[-1]]] = (
+                self._next_siblings[row]
+            )
+        else:
+            self._replace_link(key, self._next_siblings[row])
+
+        del self._rows[key]
+        self._alive[row] = False
+
+        # Identical contours stay indexed under the hash
+        h = contour_hash(points)
+        self._hashes[h].remove(key)
+        if not self._hashes[h]:
+            del self._hashes[h]
+
+        if len(self._rows) < self._n // 2:
+            self.compact()
+        return points
+
+    def set_parent(self, key: int, parent: int | None):
+        '''
+        Move a contour to the front of the children of the parent, which
+        must not be the contour itself or one of its descendants.
+        '''
+        parent = -1 if parent is None else parent
+        row = self._rows[key]
+        if parent == self._parents[row]:
+            return
+        if parent >= 0 and (parent == key or key in self.ancestors(parent)):
+            raise ValueError(
+                f'Contour {parent} is nested in contour {key}, cannot be '
+                'its parent'
+            )
+
+        self._replace_link(key, self._next_siblings[row])
+        self._parents[row] = parent
+        if parent >= 0:
+            parent_row = self._rows[parent]
+            self._next_siblings[row] = self._first_children[parent_row]
+            self._first_children[parent_row] = key
+        else:
+            self._next_siblings[row] = -1
+
+    def _replace_link(self, key: int, target: int):
+        '''Point the link of the tree leading to key to target instead.'''
+        parent = self._parents[self._rows[key]]
+        if parent >= 0 and self._first_children[self._rows[parent]] == key:
+            self._first_children[self._rows[parent]] = target
+            return
+
+        previous = np.flatnonzero(
+            (self._next_siblings[:self._n] == key) & self._mask()
+        )
+        self._next_siblings[previous] = target
+
+    def compact(self):
+        '''Drop the rows of removed contours from the arrays.'''
+        alive = np.flatnonzero(self._alive[:self._n])
+        starts, ends = self._offsets[alive], self._offsets[alive + 1]
+        lengths = ends - starts
+
+        # Indices of the points of the alive contours
+        index = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        index += np.arange(lengths.sum())
+
+        self._points = self._points[index]
+        self._npoints = len(self._points)
+        self._offsets = np.concatenate([[0], np.cumsum(lengths)])
+        for name in (
+            '_keys',
+            '_labels',
+            '_coordinates',
+            '_rois',
+            '_parents',
+            '_first_children',
+            '_next_siblings',
+            '_closed',
+            '_alive',
+        ):
+            setattr(self, name, getattr(self, name)[alive])
+
+        self._n = len(alive)
+        self._rows = {k: i for i, k in enumerate(self._keys.tolist())}
+
+    #---------------------------
+    # Queries
+    #---------------------------
+    def points(self, key: int) -> np.ndarray:
+        row = self._rows[key]
+        return self._points[self._offsets[row]:self._offsets[row + 1]
+                            ].reshape(-1, 1, 2)
+
+    def find(self, points: np.ndarray) -> int | None:
+        '''Key of the stored contour with exactly these points, if any.'''
+        points = np.reshape(points, (-1, 2))
+        for key in self._hashes.get(contour_hash(points), []):
+            if np.array_equal(self.points(key).reshape(-1, 2), points):
+                return key
+        return None
+
+    def children(self, key: int) -> list[int]:
+        '''Keys of the children of a contour, following the tree.'''
+        children = []
+        child = self._first_children[self._rows[key]]
+        while child >= 0:
+            children.append(int(child))
+            child = self._next_siblings[self._rows[child]]
+        return children
+
+    def ancestors(self, key: int) -> list[int]:
+        '''Keys of the contours enclosing a contour, innermost first.'''
+        ancestors = []
+        parent = self._parents[self._rows[key]]
+        while parent >= 0:
+            ancestors.append(int(parent))
+            parent = self._parents[self._rows[parent]]
+        return ancestors
+
+    def descendants(self, key: int) -> list[int]:
+        '''Keys of all contours nested in a contour, depth first.'''
+        descendants, stack = [], self.children(key)[::-1]
+        while stack:
+            child = stack.pop()
+            descendants.append(child)
+            stack.extend(self.children(child)[::-1])
+        return descendants
+
+    def label_code(self, label: str) -> int:
+        if label not in self.label_names:
+            self.label_names.append(label)
+        return self.label_names.index(label)
+
+    def _mask(self) -> np.ndarray:
+        return self._alive[:self._n]
+
+    def keys_array(self) -> np.ndarray:
+        return self._keys[:self._n][self._mask()]
+
+    def lengths(self) -> np.ndarray:
+        '''Number of points of each contour, in iteration order.'''
+        return np.diff(self._offsets[:self._n + 1])[self._mask()]
+
+    def where(
+        self,
+        label: str | None = None,
+        parent: int | None = None,
+        min_points: int | None = None,
+        max_points: int | None = None,
+    ) -> np.ndarray:
+        '''
+        Keys of the contours matching all given conditions, e.g.
+        store.where(label='tick') or store.where(min_points=100).
+        '''
+        mask = self._mask().copy()
+        if label is not None:
+            if label not in self.label_names:
+                return np.empty(0, dtype=np.int64)
+            mask &= self._labels[:self._n] == self.label_names.index(label)
+        if parent is not None:
+            mask &= self._parents[:self._n] == parent
+        if min_points is not None or max_points is not None:
+            lengths = np.diff(self._offsets[:self._n + 1])
+            if min_points is not None:
+                mask &= lengths >= min_points
+            if max_points is not None:
+                mask &= lengths <= max_points
+        return self._keys[:self._n][mask]
+
+    def to_arrays(self) -> tuple[np.ndarray]:
+        '''Keys, concatenated points, shape (m, 2), and offsets.'''
+        if len(self) < self._n:
+            self.compact()
+        return (
+            self._keys[:self._n].copy(),
+            self._points[:self._npoints].copy(),
+            self._offsets[:self._n + 1].copy(),
+        )
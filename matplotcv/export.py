@@ -0,0 +1,87 @@
+'''
+Export of contour points. All contours are written at once from a single
+concatenated array of points and an array of offsets, contour i being
+points[offsets[i]:offsets[i + 1]].
+'''
+import os.path
+import zipfile
+import numpy as np
+
+formats = ('csv', 'npz')
+
+
+def export_format(filename: str) -> str:
+    '''Export format matching the file extension.'''
+    fmt = os.path.splitext(filename)[1].lower().lstrip('.')
+    if fmt not in formats:
+        raise ValueError(f'Unsupported export format "{fmt}"')
+    return fmt
+
+
+def export_points(
+    filename: str,
+    keys: np.ndarray,
+    points: np.ndarray,
+    offsets: np.ndarray,
+    chunk: int = 2**20,
+):
+    '''
+    Write contour points to a file, the format being deduced from the
+    extension.
+
+    Parameters
+    ----------
+    filename : str
+        Output file, with .csv or .npz extension.
+    keys : np.ndarray
+        Contour keys, shape (n,).
+    points : np.ndarray
+        Concatenated contour points, shape (m, 2).
+    offsets : np.ndarray
+        Start of each contour in points plus the total number of points,
+        shape (n + 1,).
+    chunk : int
+        Number of points written at once by the streaming formats.
+
+    Notes
+    -----
+    CSV keeps the x, y columns of the previous exports. NPZ is the
+    columnar format: it stores x, y, keys and offsets arrays, readable
+    with np.load, the x and y columns being written chunk by chunk.
+    '''
+    keys = np.asarray(keys, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+
+    match export_format(filename):
+        case 'csv':
+            with open(filename, 'w') as f:
+                f.write('x,y\n')
+                for i in range(0, len(points), chunk):
+                    # One formatting call per chunk instead of per row
+                    rows = points[i:i + chunk]
+                    f.write(
+                        '%.10g,%.10g\n' * len(rows) % tuple(rows.ravel())
+                    )
+        case 'npz':
+            columns = {
+                'x': points[:, 0],
+                'y': points[:, 1],
+                'keys': keys,
+                'offsets': offsets,
+            }
+            with zipfile.ZipFile(filename, 'w') as archive:
+                for name, column in columns.items():
+                    # Same layout as np.savez, written chunk by chunk
+                    header = {
+                        'descr': np.lib.format.dtype_to_descr(column.dtype),
+                        'fortran_order': False,
+                        'shape': column.shape,
+                    }
+                    with archive.open(
+                        f'{name}.npy', 'w', force_zip64=True
+                    ) as f:
+                        np.lib.format.write_array_header_1_0(f, header)
+                        for i in range(0, len(column), chunk):
+                            f.write(
+                                np.ascontiguousarray(column[i:i + chunk])
+                            )
@@ -0,0 +1,70 @@
+'''
+Statistics of 8-bit images derived from their 256-bin histogram, which
+OpenCV computes in a single pass over the pixels. They replace sorting
+or scanning the whole image for automatic thresholds.
+'''
+import functools
+import numpy as np
+import cv2 as cv
+
+
+def histogram(image: np.ndarray) -> np.ndarray:
+    '''Histogram of a uint8 image over all its channels.'''
+    image = np.ascontiguousarray(image)
+    hist = cv.calcHist(
+        [image.reshape(image.shape[0], -1)], [0], None, [256], [0, 256]
+    )
+    return hist.ravel().astype(np.int64)
+
+
+def canny_thresholds(median: float, sigma: float = 0.33) -> tuple[int]:
+    '''Lower and upper Canny thresholds spread around the median.'''
+    lower = int(max(0, (1.0 - sigma) * median))
+    upper = int(min(255, (1.0 + sigma) * median))
+    return lower, upper
+
+
+class ImageStats:
+    '''Statistics of a uint8 image given its histogram.'''
+
+    def __init__(self, hist: np.ndarray):
+        self.hist = np.asarray(hist, dtype=np.int64)
+        self.count = int(self.hist.sum())
+
+    @classmethod
+    def from_image(cls, image: np.ndarray):
+        return cls(histogram(image))
+
+    @functools.cached_property
+    def cdf(self) -> np.ndarray:
+        return np.cumsum(self.hist)
+
+    def quantile(self, q: float) -> int:
+        '''Smallest value not exceeded by a fraction q of the pixels.'''
+        return int(np.searchsorted(self.cdf, q * self.count))
+
+    @functools.cached_property
+    def median(self) -> float:
+        '''Median of the pixels, same as np.median.'''
+        lo, hi = np.searchsorted(
+            self.cdf, [(self.count - 1) // 2 + 1, self.count // 2 + 1]
+        )
+        return (lo + hi) / 2
+
+    @functools.cached_property
+    def mean(self) -> float:
+        return float(self.hist @ np.arange(256) / self.count)
+
+    @functools.cached_property
+    def otsu(self) -> int:
+        '''
+        Otsu threshold, maximizing the variance between the pixels above
+        and not above it, same as cv.threshold with THRESH_OTSU.
+        '''
+        p = self.hist / self.count
+        omega = np.cumsum(p)
+        mu = np.cumsum(p * np.arange(256))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            variance = (mu[-1] * omega - mu)**2 / (omega * (1 - omega))
+        return int(np.argmax(np.nan_to_num(variance)))
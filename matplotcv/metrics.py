@@ -1,32 +1,158 @@
-import math
 import numpy as np
-from scipy.linalg import solve
 
 
 def point_segment_distance(
     point: tuple[float], segment: tuple[tuple[float]]
 ) -> float:
     '''Calculate the distance between a point and a line segment.'''
-    x, y = point
-    sx, sy = segment[0]
-    ex, ey = segment[1]
+    starts, ends = np.asarray(segment, dtype=float).reshape(2, 1, 2)
+    return float(point_segments_distance(point, starts, ends)[0])
 
-    length = (ex - sx)**2 + (ey - sy)**2
-    if length == 0:  # Segment's start and end points are the same
-        return math.sqrt((x - sx)**2 + (y - sy)**2)
 
-    # Calculate the projection of the point onto the line
-    tau = max(
-        0, min(1, ((x - sx) * (ex - sx) + (y - sy) * (ey - sy)) / length)
+def segments_distance(
+    points: np.ndarray, starts: np.ndarray, ends: np.ndarray
+) -> np.ndarray:
+    '''
+    Calculate the distances between points and line segments.
+
+    Parameters
+    ----------
+    points : np.ndarray
+        Point coordinates, shape (..., 2).
+    starts : np.ndarray
+        Start points of the segments, shape (..., 2), broadcastable
+        against points.
+    ends : np.ndarray
+        End points of the segments, same shape as starts.
+
+    Returns
+    -------
+    np.ndarray
+        Distances with the broadcast shape of the inputs without the
+        last axis.
+    '''
+    points = np.asarray(points, dtype=float)
+    starts = np.asarray(starts, dtype=float)
+    d = np.asarray(ends, dtype=float) - starts
+    length = np.sum(d * d, axis=-1)
+
+    # Degenerate segments are projected onto their start point
+    tau = np.sum((points - starts) * d, axis=-1)
+    tau = np.divide(
+        tau,
+        length,
+        out=np.zeros(np.broadcast(tau, length).shape),
+        where=length > 0,
+    )
+    tau = np.clip(tau, 0, 1)
+
+    proj = starts + tau[..., None] * d
+    return np.hypot(*np.moveaxis(points - proj, -1, 0))
+
+
+def point_segments_distance(
+    point: tuple[float], starts: np.ndarray, ends: np.ndarray
+) -> np.ndarray:
+    '''Calculate the distances between a point and many line segments.'''
+    return segments_distance(np.asarray(point, dtype=float), starts, ends)
+
+
+def polyline_segments(polyline: np.ndarray) -> tuple[np.ndarray]:
+    '''
+    Split a polyline, given as (n, 2) or OpenCV (n, 1, 2) points, into
+    arrays of segment start and end points. A single point polyline
+    yields one degenerate segment.
+    '''
+    polyline = np.asarray(polyline, dtype=float).reshape(-1, 2)
+    if len(polyline) == 1:
+        polyline = np.repeat(polyline, 2, axis=0)
+    return polyline[:-1], polyline[1:]
+
+
+def points_polyline_distance(
+    points: np.ndarray, polyline: np.ndarray, chunk: int = 2**22
+) -> np.ndarray:
+    '''
+    Calculate the distance from each of many points to one polyline.
+
+    Parameters
+    ----------
+    points : np.ndarray
+        Point coordinates, shape (m, 2).
+    polyline : np.ndarray
+        Polyline vertices, shape (n, 2) or (n, 1, 2).
+    chunk : int
+        Maximum number of point-segment pairs evaluated at once, bounds
+        the size of the temporary arrays.
+
+    Returns
+    -------
+    np.ndarray
+        Distances, shape (m,).
+    '''
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    starts, ends = polyline_segments(polyline)
+
+    step = max(1, chunk // len(starts))
+    return np.concatenate([
+        segments_distance(points[i:i + step, None], starts, ends).min(axis=1)
+        for i in range(0, len(points), step)
+    ]) if len(points) else np.empty(0)
+
+
+def point_polylines_distance(
+    point: tuple[float], polylines: list[np.ndarray]
+) -> np.ndarray:
+    '''
+    Calculate the distance from one point to each of many polylines.
+
+    Parameters
+    ----------
+    point : tuple[float]
+        Point coordinates (x, y).
+    polylines : list[np.ndarray]
+        Polylines, each of shape (n, 2) or (n, 1, 2).
+
+    Returns
+    -------
+    np.ndarray
+        Distances, shape (len(polylines),).
+    '''
+    if not len(polylines):
+        return np.empty(0)
+
+    segments = [polyline_segments(p) for p in polylines]
+    counts = [len(s) for s, _ in segments]
+    distances = point_segments_distance(
+        point,
+        np.concatenate([s for s, _ in segments]),
+        np.concatenate([e for _, e in segments]),
     )
-    proj = (sx + tau * (ex - sx), sy + tau * (ey - sy))
 
-    return math.sqrt((x - proj[0])**2 + (y - proj[1])**2)
+    # Every polyline owns at least one segment
+    return np.minimum.reduceat(distances, np.cumsum([0] + counts[:-1]))
+
+
+def nearest_segment(point: tuple[float],
+                    polyline: np.ndarray) -> tuple[int, float]:
+    '''
+    Find the segment of a polyline closest to the point.
+
+    Returns
+    -------
+    tuple[int, float]
+        Index of the segment, i.e. of its start vertex, and the distance
+        from the point to it.
+    '''
+    distances = point_segments_distance(point, *polyline_segments(polyline))
+    i = int(np.argmin(distances))
+    return i, float(distances[i])
 
 
 def affine_map(x: np.ndarray, y: np.ndarray) -> np.ndarray:
     '''
     Compute the augmented matrix for affine transformation from x to y.
+    With more than 3 points, the transformation is the least-squares fit.
 
     The affine transformation from x to y is given by
         [y0, y1] = T @ [x0, x1, 1],
@@ -39,7 +165,7 @@ def affine_map(x: np.ndarray, y: np.ndarray) -> np.ndarray:
     ----------
     x : np.ndarray
         Source points, shape (2, n), where 2 stands for the number of
-        dimensions and n - for the number of points.
+        dimensions and n >= 3 - for the number of points.
     y : np.ndarray
         Target points, shape (2, n).
 
@@ -49,6 +175,15 @@ def affine_map(x: np.ndarray, y: np.ndarray) -> np.ndarray:
         Augmented affine transformation matrix T' defined as follows:
             T' = [[a00, a01, b0]
                   [a10, a11, b1].
+
+    Raises
+    ------
+    ValueError
+        If the source points are collinear, in which case the
+        transformation is not unique.
     '''
     x = np.concatenate([x, np.ones([1, x.shape[1]])], axis=0)
-    return solve(x.T, y.T).T
\ No newline at end of file
+    T, _, rank, _ = np.linalg.lstsq(x.T, y.T, rcond=None)
+    if rank < 3:
+        raise ValueError('Source points are collinear')
+    return T.T
\ No newline at end of file
@@ -1,11 +1,17 @@
 import os.path
 import warnings
+import functools
+import threading
+import tracemalloc
+from contextlib import contextmanager
 from collections import OrderedDict
-from dataclasses import dataclass, field
 import numpy as np
 import cv2 as cv
 from exceptions import PipelineError
-from utils import standard_coordinate
+from contours import ContourStore
+from imagestats import ImageStats, canny_thresholds
+from tiling import open_source, tiled_edges, tiled_contours
+from profiling import Profiler, profiled
 
 supported_exts = (
     '.png',
@@ -27,46 +33,314 @@ sizes = {
     '4k': (3840, 2160),
 }
 
+# Formats whose decoder can skip resolution, see read_image
+reduced_exts = ('.jpg', '.jpeg')
+reduced_flags = {
+    2: cv.IMREAD_REDUCED_COLOR_2,
+    4: cv.IMREAD_REDUCED_COLOR_4,
+    8: cv.IMREAD_REDUCED_COLOR_8,
+}
+non_frames = (0xc4, 0xc8, 0xcc)
+
+
+def target_size(shape: tuple[int], size: str) -> tuple[int]:
+    '''
+    Width and height of an image of the given shape resized to a size
+    preset, keeping the aspect ratio.
+    '''
+    try:
+        target_width, target_height = sizes[size]
+    except KeyError as e:
+        raise ValueError(f'Size "{size}" not supported') from e
+
+    h, w = shape[0], shape[1]
+    aspect_ratio = w / h
+
+    if w >= h:
+        target_height = int(target_width / aspect_ratio)
+    else:
+        target_width = int(target_height * aspect_ratio)
+    return target_width, target_height
+
+
+def jpeg_shape(filename: str) -> tuple[int] | None:
+    '''
+    Height and width of a JPEG image read from its frame header, without
+    decoding it. Returns None if no frame header is found.
+    '''
+    with open(filename, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xff:
+                return None
+            if marker[1] == 0xff:  # Fill byte
+                f.seek(-1, os.SEEK_CUR)
+                continue
+            if marker[1] == 0x01 or 0xd0 <= marker[1] <= 0xd7:
+                continue  # Markers without a segment
+
+            segment = f.read(2)
+            if len(segment) < 2:
+                return None
+            length = int.from_bytes(segment, 'big')
+
+            # Start of frame markers, which DHT, JPG and DAC are not
+            if 0xc0 <= marker[1] <= 0xcf and marker[1] not in non_frames:
+                header = f.read(5)
+                if len(header) < 5:
+                    return None
+                return (
+                    int.from_bytes(header[1:3], 'big'),
+                    int.from_bytes(header[3:5], 'big'),
+                )
+            f.seek(length - 2, os.SEEK_CUR)
+
+
+def read_image(filename: str, size: str | None = None) -> np.ndarray | None:
+    '''
+    Decode an image, optionally resized to a size preset. JPEG images are
+    then decoded at the smallest of 1/2, 1/4 and 1/8 of their resolution
+    that is not below the preset, which the decoder does without
+    decoding the full image, the resolution being read from the file
+    header. Returns None if the image cannot be read.
+    '''
+    _, ext = os.path.splitext(filename)
+    shape = None
+    if size is not None and ext.lower() in reduced_exts:
+        try:
+            shape = jpeg_shape(filename)
+        except OSError:
+            pass  # Reported by cv.imread
 
-@dataclass
-class Contour:
-    '''Stores contour points and additional information.'''
-    points: np.ndarray
-    label: str = field(default='', init=False)
-    _coordinate: tuple | None = field(default=None, init=False)
-    closed: bool = False
-    roi: tuple | None = field(default=None, init=False)
-    children: set[int] = field(default_factory=set, init=False)
+    if shape is None:
+        image = cv.imread(filename)
+    else:
+        w, h = target_size(shape, size)
+        factor = 8
+        while factor > 1 and -(-shape[1] // factor) < w:
+            factor //= 2
+
+        if factor == 1:
+            image = cv.imread(filename)
+        else:
+            image = cv.imread(filename, reduced_flags[factor])
+
+    if image is None or size is None:
+        return image
+    return resize_to(image, size)
+
+
+def resize_to(image: np.ndarray, size: str) -> np.ndarray:
+    '''Image resized to a size preset, unchanged if it is smaller.'''
+    w, h = target_size(image.shape, size)
+    if w > image.shape[1]:
+        warnings.warn('Cannot increase the size of the image')
+        return image
+    return cv.resize(image, (w, h))
+
+
+def split_at_corners(
+    points: np.ndarray,
+    epsilon: float = 5.0,
+    closed: bool = False,
+) -> list[np.ndarray]:
+    '''
+    Split contour points at the corners of their polygonal approximation.
+
+    Parameters
+    ----------
+    points : np.ndarray
+        Contour points, shape (n, 1, 2) or (n, 2).
+    epsilon : float
+        Approximation accuracy passed to cv.approxPolyDP.
+    closed : bool
+        Whether the contour is closed, in which case the segment joining
+        the last and the first point is kept as a subcontour too.
+
+    Returns
+    -------
+    list[np.ndarray]
+        Subcontours of shape (m, 1, 2). Consecutive subcontours share
+        their corner point.
+    '''
+    points = np.ascontiguousarray(points, dtype=np.int32).reshape(-1, 2)
+    corners = cv.approxPolyDP(points.reshape(-1, 1, 2), epsilon, closed)
+
+    # Compare points as single int64 words instead of pairs of int32
+    corners = np.ascontiguousarray(corners).reshape(-1, 2)
+    is_corner = np.isin(points.view(np.int64), corners.view(np.int64))
+
+    bounds = np.unique(
+        np.concatenate([[0], np.flatnonzero(is_corner), [len(points) - 1]])
+    )
+    if len(bounds) < 2:
+        return [points.reshape(-1, 1, 2)]
+
+    contours = [points[i:j + 1] for i, j in zip(bounds[:-1], bounds[1:])]
+    if closed:
+        contours.append(points[[-1, 0]])
+    return [c.reshape(-1, 1, 2) for c in contours]
+
+
+class StageCache:
+    '''
+    Least recently used cache of intermediate stage results, bounded by
+    the total number of bytes of the cached images.
+    '''
+
+    def __init__(self, budget: int, on_evict=None):
+        self.budget = budget
+        self.nbytes = 0
+        self.on_evict = on_evict  # Called with each evicted image
+        self._entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def holds(self, image: np.ndarray) -> bool:
+        '''Whether the image itself is cached, under any key.'''
+        return any(image is cached for cached in self._entries.values())
+
+    def get(self, key):
+        image = self._entries.get(key)
+        if image is not None:
+            self._entries.move_to_end(key)
+        return image
+
+    def put(self, key, image: np.ndarray):
+        if key in self._entries:
+            self._evict(key)
+
+        if image.nbytes > self.budget:
+            return
+
+        self._entries[key] = image
+        self.nbytes += image.nbytes
+
+        while self.nbytes > self.budget:
+            self._evict(next(iter(self._entries)))
+
+    def discard(self, predicate):
+        '''Evict the images whose key matches the predicate.'''
+        for key in [k for k in self._entries if predicate(k)]:
+            self._evict(key)
+
+    def _evict(self, key):
+        image = self._entries.pop(key)
+        self.nbytes -= image.nbytes
+        if self.on_evict is not None:
+            self.on_evict(image)
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+
+class BufferPool:
+    '''
+    Images no longer used by the pipeline, kept to be written over by
+    the next stage outputs of the same shape instead of allocating new
+    ones. At most depth images of each shape are kept. Images lent out
+    of the pipeline are never kept, since the borrower may still use
+    them.
+    '''
+
+    def __init__(self, depth: int = 2):
+        self.depth = depth
+        self._buffers = {}
+        self._lent = set()  # Ids of the images lent out
+
+    def take(self, shape: tuple[int], dtype=np.uint8) -> np.ndarray | None:
+        '''An image of this shape and type, None if none is left.'''
+        buffers = self._buffers.get((tuple(shape), np.dtype(dtype)))
+        if not buffers:
+            return None
+
+        return buffers.pop()
+
+    def lend(self, image: np.ndarray | None):
+        '''Mark an image handed out of the pipeline.'''
+        if image is not None:
+            self._lent.add(id(image))
+
+    def give(self, image: np.ndarray):
+        if id(image) in self._lent:
+            # The pipeline is done with it, so its id may be reused
+            self._lent.discard(id(image))
+            return
+        if image.base is not None:  # Views do not own their memory
+            return
+
+        buffers = self._buffers.setdefault((image.shape, image.dtype), [])
+        if len(buffers) < self.depth and all(image is not b for b in buffers):
+            buffers.append(image)
 
-    @property
-    def coordinate(self):
-        return self._coordinate
+    def clear(self):
+        self._buffers.clear()
+        self._lent.clear()
 
-    @coordinate.setter
-    def coordinate(self, value: str):
-        try:
-            x, y = value.split(',')
-            self._coordinate = (standard_coordinate(x), standard_coordinate(y))
-        except Exception as e:
-            raise ValueError(f'Invalid coordinate format: {value}') from e
 
-        print(f'Coordinate set to {self.coordinate}')
+def locked(method):
+    '''Run a Pipeline method holding the lock of the pipeline.'''
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
 
 
 class Pipeline:
-    '''Pipeline controls all OpenCV computations.'''
-    _processed = None
-    _original = None
-    isedgy = False
-    blurring = 0
-    contours = {}
+    '''
+    Pipeline controls all OpenCV computations.
+
+    Image operations are recorded as a chain of stages applied to the
+    original image, each stage being an operation name and a tuple of
+    parameters. Intermediate results are cached by the chain prefix that
+    produced them, so undo, redo and parameter changes only recompute
+    the stages downstream of the change.
+
+    Images are never modified once produced, so processed, original and
+    cached images share memory instead of being copied. Results that can
+    no longer be reached, e.g. those of the previous parameters of a
+    stage, are recycled as the destinations of new stage outputs, unless
+    they were handed out by processed, original or display_image.
+
+    All state belongs to the instance, and operations hold the lock of
+    the pipeline, so that a pipeline can be used from several threads,
+    and many pipelines can run in parallel on a thread pool since OpenCV
+    releases the GIL.
+    '''
+
+    def __init__(self, cache_budget: int = 512 * 2**20):
+        self.lock = threading.RLock()
+        self._processed = None
+        self._original = None
+        self.version = 0  # Incremented whenever original or processed change
+        self.stages = []
+        self._cursor = 0  # Number of applied stages
+        self.pool = BufferPool()
+        self._released = []  # Evicted images still processed
+        self.cache = StageCache(cache_budget, on_evict=self._recycle)
+        self.stats = {}  # Image statistics by chain of stages
+        self.pyramids = StageCache(cache_budget // 4)  # See display_image
+        self._chain = ()  # Chain of stages producing the image processed
+        self.profiler = None
+        self._loads = 0  # Number of loaded images, see load_image
+        self.reset_contours()
 
     @property
     def processed(self):
+        self.pool.lend(self._processed)
         return self._processed
 
     @property
     def original(self):
+        self.pool.lend(self._original)
         return self._original
 
     @property
@@ -77,107 +351,446 @@ class Pipeline:
     def isgray(self):
         return self.processed.ndim == 2
 
+    @property
+    def isedgy(self):
+        '''Whether the image is binary, ready for contour detection.'''
+        return any(
+            op in ('edges', 'threshold') for op, _ in self.applied_stages
+        )
+
+    @property
+    def blurring(self):
+        return sum(
+            self.kernel_size(*params)
+            for op, params in self.applied_stages if op == 'blur'
+        )
+
+    @property
+    def applied_stages(self):
+        return self.stages[:self._cursor]
+
     @property
     def aspect(self):
         if not self.isempty:
             return self.original.shape[1] / self.original.shape[0]
 
-    def load_image(self, filename: str):
+    @locked
+    @profiled
+    def load_image(
+        self,
+        filename: str,
+        size: str | None = None,
+        progressive: bool = False,
+    ):
+        '''
+        Load an image, optionally resized to a size preset, which for
+        JPEG images is much faster than resizing after loading.
+
+        With progressive, a JPEG image is first loaded as a preview
+        decoded at 1/8 of its resolution, and a function completing the
+        load is returned. The function decodes the image and replaces the
+        preview, re-applying the stages applied meanwhile, and is meant
+        to be called in the background, like the other operations. Other
+        formats, PNG included, are loaded directly and None is returned:
+        their decoders cannot skip resolution, so a preview would cost
+        as much as the full decode.
+        '''
         _, ext = os.path.splitext(filename)
         if ext.lower() not in supported_exts:
             raise ValueError(f'Unsupported file extension {ext}')
 
-        image = cv.imread(filename)
+        progressive = progressive and ext.lower() in reduced_exts
+        if progressive:
+            image = cv.imread(filename, reduced_flags[8])
+        else:
+            image = read_image(filename, size)
 
         if image is None:
             raise PipelineError('Failed to load image')
 
-        self._original = image
-        self._processed = image.copy()
+        self._set_original(image)
 
+        if progressive:
+            return functools.partial(
+                self._complete_load, filename, size, self._loads
+            )
+
+    @locked
+    @profiled
+    def load_array(self, image: np.ndarray, size: str | None = None):
+        '''
+        Load an image given as an array, e.g. a video frame, optionally
+        resized to a size preset.
+        '''
+        if size is not None:
+            image = resize_to(image, size)
+        self._set_original(image)
+
+    def _set_original(self, image: np.ndarray):
+        '''Start over from a new original image.'''
+        reuse = self._original is not None and (
+            self._original.shape == image.shape
+        )
+        self._original = self._processed = image
+
+        if reuse:
+            # Stage buffers are reused by the next image, e.g. video frames
+            self.cache.discard(lambda key: True)
+        else:
+            self.cache.clear()
+            self.pool.clear()
+        self.pool.lend(image)  # Owned by the caller
+
+        self.stats.clear()
+        self.pyramids.clear()
+        self.stages, self._cursor = [], 0
+        self._loads += 1
+        self.version += 1
+
+    def _complete_load(self, filename: str, size: str | None, load: int):
+        image = read_image(filename, size)
+        if image is None:
+            raise PipelineError('Failed to load image')
+
+        with self.lock:
+            if load != self._loads or self.isempty:
+                return  # Another image was loaded or the pipeline cleared
+
+            self._original = image
+            self.cache.clear()
+            self.stats.clear()
+            self.pyramids.clear()
+            self.pool.clear()
+            self.reset_contours()
+            self._evaluate(self.applied_stages)
+
+    @locked
     def clear(self, which: str = 'all'):
         if not self.isempty:
             match which:
                 case 'all':
                     self._processed = self._original = None
+                    self.cache.clear()
+                    self.stats.clear()
+                    self.pyramids.clear()
+                    self.pool.clear()
                 case 'processed':
-                    self._processed = self._original.copy()
+                    self._processed = self._original
+                    self.cache.discard(lambda key: True)
                 case _:
                     raise ValueError('Bad clear option')
 
-            self.blurring = 0
-            self.isedgy = False
-            self.contours = {}
+            self.stages, self._cursor = [], 0
+            self.reset_contours()
+            self.version += 1
 
+    @locked
+    @profiled
     def resize(self, size: str):
         if not self.isempty:
             self.clear('processed')
 
-            h, w = self.processed.shape[0], self.processed.shape[1]
-            aspect_ratio = w / h
-
-            try:
-                target_width, target_height = sizes[size]
-            except KeyError as e:
-                raise ValueError(f'Size "{size}" not supported') from e
-
-            if w >= h:
-                target_height = int(target_width / aspect_ratio)
-            else:
-                target_width = int(target_height * aspect_ratio)
+            target_width, target_height = target_size(
+                self.processed.shape, size
+            )
 
-            if target_width > w:
+            if target_width > self.processed.shape[1]:
                 warnings.warn('Cannot increase the size of the image')
                 return
 
-            self._original = cv.resize(
+            self._original = self._processed = cv.resize(
                 self.processed, (target_width, target_height)
             )
-            self._processed = self._original.copy()
-
+            self.cache.clear()
+            self.stats.clear()
+            self.pyramids.clear()
+            self.pool.clear()
+            self.version += 1
+
+    @locked
+    @profiled
     def gray(self):
         if not self.isempty and not self.isgray:
-            self._processed = cv.cvtColor(self.processed, cv.COLOR_BGR2GRAY)
+            self.push('gray')
 
+    @locked
+    @profiled
     def blur(self, kind: str = 'gaussian', n: int = 1):
         if not self.isempty:
-            match kind:
-                case 'gaussian':
-                    k = 3 + 2 * n
-                    self._processed = cv.GaussianBlur(
-                        self._processed, (k, k), 0
-                    )
-                case _:
-                    raise ValueError('Bad blur function')
-            self.blurring += k
+            self.push('blur', kind, n)
 
+    @locked
+    @profiled
     def edges(self, kind: str = 'canny'):
+        '''Detect edges with 'canny', 'sobel' or 'scharr'.'''
         if not self.isempty:
-            match kind:
-                case 'canny':
-                    # Automatic thresholding based on median
-                    sigma = 0.33
-                    m = np.median(self._processed)
-                    lower = int(max(0, (1.0 - sigma) * m))
-                    upper = int(min(255, (1.0 + sigma) * m))
-
-                    self._processed = cv.Canny(self._processed, lower, upper)
-                case _:
-                    raise ValueError('Bad edge detection function')
+            self.push('edges', kind)
+
+    @locked
+    @profiled
+    def threshold(self, kind: str = 'otsu'):
+        '''Binarize the image with 'otsu' or 'adaptive' thresholding.'''
+        if not self.isempty:
+            self.push('threshold', kind)
 
-            self.isedgy = True
+    @locked
+    def display_image(
+        self, which: str = 'processed', level: int = 0
+    ) -> np.ndarray:
+        '''
+        Level of the image pyramid of the processed or original image,
+        each level being half the size of the previous one, level 0 being
+        the image itself. Levels are cached by chain of stages, so that
+        undo, redo and zooming do not rebuild them.
+        '''
+        match which:
+            case 'processed':
+                chain = tuple(self.applied_stages)
+            case 'original':
+                chain = ()
+            case _:
+                raise ValueError('Bad display image option')
+
+        if level == 0:
+            image = self._original if not chain else self._processed
+            self.pool.lend(image)
+            return image
+
+        image = self.pyramids.get((chain, level))
+        if image is None:
+            image = cv.pyrDown(self.display_image(which, level - 1))
+            self.pyramids.put((chain, level), image)
+        return image
+
+    @contextmanager
+    def profile(self, trace_memory: bool = False):
+        '''
+        Record the operations run within the context. Tracing allocated
+        memory uses tracemalloc and slows the operations down.
 
-    def find_contours(self, external: bool = False, key: int | None = None):
+        >>> with pipeline.profile() as profiler:
+        ...     pipeline.gray()
+        >>> profiler.summary()
+        '''
+        profiler = Profiler(trace_memory)
+        previous, self.profiler = self.profiler, profiler
+
+        started = trace_memory and not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        try:
+            yield profiler
+        finally:
+            self.profiler = previous
+            if started:
+                tracemalloc.stop()
+
+    #---------------------------
+    # Stage chain
+    #---------------------------
+    @locked
+    def push(self, operation: str, *params):
+        '''
+        Apply a new stage after the current one. Stages previously undone
+        are discarded.
+        '''
+        stages = self.applied_stages + [(operation, params)]
+        if len(self.stages) > self._cursor and self.stages[self._cursor] != (
+            operation, params
+        ):
+            self._discard_chain(self.stages[:self._cursor + 1])
+
+        self._evaluate(stages)
+        self.stages, self._cursor = stages, len(stages)
+
+    @locked
+    def undo(self):
+        if self._cursor > 0:
+            self._cursor -= 1
+            self._evaluate(self.applied_stages)
+
+    @locked
+    def redo(self):
+        if self._cursor < len(self.stages):
+            self._cursor += 1
+            self._evaluate(self.applied_stages)
+
+    @locked
+    def set_stage(self, index: int, *params):
+        '''Change the parameters of a stage and recompute the chain.'''
+        operation, _ = self.stages[index]
+
+        stages = self.stages.copy()
+        stages[index] = (operation, params)
+        if stages[index] != self.stages[index]:
+            self._discard_chain(self.stages[:index + 1])
+
+        self._evaluate(stages[:self._cursor])
+        self.stages = stages
+
+    def _discard_chain(self, stages: list[tuple]):
+        '''
+        Evict the cached results of the chains starting with stages, once
+        they cannot be reached by undo and redo anymore.
+        '''
+        prefix = tuple(stages)
+        self.cache.discard(lambda key: key[:len(prefix)] == prefix)
+
+    def _recycle(self, image: np.ndarray):
+        '''Give an evicted image to the pool if nothing uses it anymore.'''
+        if image is self._processed:
+            self._released.append(image)  # Recycled once replaced
+        elif image is not self._original and not self.cache.holds(image):
+            self.pool.give(image)
+
+    def _evaluate(self, stages: list[tuple]):
+        '''
+        Compute the result of the chain of stages starting from the
+        longest prefix found in the cache.
+        '''
+        image, start = self._original, 0
+        for i in range(len(stages), 0, -1):
+            cached = self.cache.get(tuple(stages[:i]))
+            if cached is not None:
+                image, start = cached, i
+                break
+
+        for i in range(start, len(stages)):
+            operation, params = stages[i]
+            self._chain = tuple(stages[:i])  # Input of the stage
+            image = getattr(self, f'_{operation}')(image, *params)
+            self.cache.put(tuple(stages[:i + 1]), image)
+
+        self._processed = image
+        self.version += 1
+
+        released, self._released = self._released, []
+        for image in released:
+            self._recycle(image)
+
+    @staticmethod
+    def kernel_size(kind: str = 'gaussian', n: int = 1) -> int:
+        return 3 + 2 * n
+
+    def _gray(self, image: np.ndarray) -> np.ndarray:
+        if image.ndim == 2:
+            return image
+        return cv.cvtColor(
+            image, cv.COLOR_BGR2GRAY, dst=self.pool.take(image.shape[:2])
+        )
+
+    def _blur(
+        self, image: np.ndarray, kind: str = 'gaussian', n: int = 1
+    ) -> np.ndarray:
+        match kind:
+            case 'gaussian':
+                k = self.kernel_size(kind, n)
+                return cv.GaussianBlur(
+                    image, (k, k), 0, dst=self.pool.take(image.shape)
+                )
+            case _:
+                raise ValueError('Bad blur function')
+
+    def image_stats(self, image: np.ndarray) -> ImageStats:
+        '''
+        Histogram statistics of the input image of the stage being
+        evaluated, or of its grayscale version, computed once per chain
+        of stages.
+        '''
+        key = (self._chain, image.ndim)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = ImageStats.from_image(image)
+        return stats
+
+    def _edges(self, image: np.ndarray, kind: str = 'canny') -> np.ndarray:
+        match kind:
+            case 'canny':
+                # Automatic thresholding based on median
+                stats = self.image_stats(image)
+                return cv.Canny(
+                    image,
+                    *canny_thresholds(stats.median),
+                    edges=self.pool.take(image.shape[:2]),
+                )
+            case 'sobel' | 'scharr':
+                image = self._gray(image)
+                ksize = cv.FILTER_SCHARR if kind == 'scharr' else 3
+                gx = cv.Sobel(image, cv.CV_16S, 1, 0, ksize=ksize)
+                gy = cv.Sobel(image, cv.CV_16S, 0, 1, ksize=ksize)
+                magnitude = cv.addWeighted(
+                    cv.convertScaleAbs(gx), 0.5, cv.convertScaleAbs(gy), 0.5, 0
+                )
+
+                # Strong gradients split from weak ones by Otsu
+                t = ImageStats.from_image(magnitude).otsu
+                _, edges = cv.threshold(
+                    magnitude,
+                    t,
+                    255,
+                    cv.THRESH_BINARY,
+                    dst=self.pool.take(image.shape),
+                )
+                return edges
+            case _:
+                raise ValueError('Bad edge detection function')
+
+    def _threshold(self, image: np.ndarray, kind: str = 'otsu') -> np.ndarray:
+        image = self._gray(image)
+        stats = self.image_stats(image)
+
+        # Plots are drawn dark on light, contours are found on white
+        mode = (
+            cv.THRESH_BINARY_INV
+            if stats.median > stats.otsu else cv.THRESH_BINARY
+        )
+
+        match kind:
+            case 'otsu':
+                _, binary = cv.threshold(
+                    image,
+                    stats.otsu,
+                    255,
+                    mode,
+                    dst=self.pool.take(image.shape),
+                )
+                return binary
+            case 'adaptive':
+                return cv.adaptiveThreshold(
+                    image,
+                    255,
+                    cv.ADAPTIVE_THRESH_MEAN_C,
+                    mode,
+                    11,
+                    2,
+                    dst=self.pool.take(image.shape),
+                )
+            case _:
+                raise ValueError('Bad threshold function')
+
+    @locked
+    @profiled
+    def find_contours(
+        self, external: bool = False, key: int | None = None
+    ) -> list[int] | None:
+        '''
+        Find the contours of the entire image, or the children of the
+        contour given by key and return their keys. The nesting of the
+        contours is kept unless only external contours are searched, so
+        children are then looked up rather than searched in the image.
+        '''
         if not self.isempty:
             if key is None:  # Search in the entire image
-                contours, _ = cv.findContours(
+                contours, hierarchy = cv.findContours(
                     self._processed,
                     cv.RETR_EXTERNAL if external else cv.RETR_TREE,
                     cv.CHAIN_APPROX_SIMPLE,
                 )
-                self.contours = OrderedDict(
-                    (i, Contour(c)) for i, c in enumerate(contours)
-                )
+                self.reset_contours(contours, None if external else hierarchy)
+            elif self.contours.tree:
+                if key not in self.contours:
+                    raise ValueError(f'Contour {key} not found')
+                return self.contours.children(key)
             else:  # Search in the parent contour
                 self.contour_roi(key)
                 x, y, w, h = self.contours[key].roi
@@ -186,52 +799,101 @@ class Pipeline:
                 contours, _ = cv.findContours(
                     roi, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE
                 )
+                # The search may find the contours enclosing the parent,
+                # which cannot become its children
+                ancestors = set(self.contours.ancestors(key))
                 for contour in contours:
                     # Translate contour to the original image coordinates
                     contour += np.array([x, y])
 
-                    idx = [  # Check if the contour already exists
-                        i for i, c in self.contours.items()
-                        if np.array_equal(contour, c)
-                    ]
-                    if idx:
-                        self.contours[key].children.add(idx[0])
-                    else:
-                        idx = max(self.contours) + 1
-                        self.contours[idx] = Contour(contour)
-                        self.contours[key].children.add(idx)
+                    idx = self.find_contour(contour)
+                    if idx is None:
+                        idx = self.add_contour(contour)
+                    if idx != key and idx not in ancestors:
+                        self.contours.set_parent(idx, key)
+                return self.contours.children(key)
 
+    @locked
+    @profiled
     def split_contour(self, key: int, epsilon: float = 5.0) -> list[int]:
         '''
         Split contour at corners to obtain subcontours.
         '''
-        contour = self.contours.get(key)
-        if contour is None:
-            raise ValueError(f'Contour {key} not found')
+        return self.split_contours([key], epsilon)[key]
 
-        points = contour.points
+    @locked
+    def split_contours(self,
+                       keys: list[int],
+                       epsilon: float = 5.0) -> dict[int, list[int]]:
+        '''
+        Split many contours at their corners in one call. Returns the keys
+        of the subcontours replacing each split contour.
+        '''
+        for key in keys:
+            if self.contours.get(key) is None:
+                raise ValueError(f'Contour {key} not found')
+
+        subkeys = {}
+        for key in keys:
+            # Subcontours take the place of the contour in the tree
+            contour = self.contours[key]
+            subkeys[key] = self.contours.extend(
+                split_at_corners(contour.points, epsilon, contour.closed),
+                parent=-1 if contour.parent is None else contour.parent,
+            )
+            self.remove_contour(key)
+        return subkeys
+
+    def find_contours_tiled(
+        self,
+        source: str | np.ndarray,
+        tile: int = 2048,
+        n: int = 1,
+        out: np.ndarray | None = None,
+    ) -> np.ndarray:
+        '''
+        Run gray, gaussian blur of level n, Canny edges and contour search
+        tile by tile, so that peak memory is bounded by the tile size and
+        the edges spanning several tiles rather than the image size. The
+        source may be a file name, with .npy files being memory-mapped, or
+        an array. The original and processed images are left untouched.
 
-        corners = cv.approxPolyDP(
-            np.array(points, dtype=np.int32).reshape([-1, 1, 2]),
-            epsilon,
-            contour.closed,
-        )
+        Returns the edge map, written to out if given, e.g. an np.memmap.
+        '''
+        source = open_source(source)
+        edges = tiled_edges(source, tile, self.kernel_size(n=n), out=out)
+        contours = tiled_contours(edges, tile)
+        with self.lock:
+            self.reset_contours(contours)
+        return edges
+
+    @locked
+    def reset_contours(
+        self,
+        contours: list[np.ndarray] = (),
+        hierarchy: np.ndarray | None = None,
+    ):
+        '''
+        Replace all contours, keys are assigned in order from 0. The
+        hierarchy is the one returned by cv.findContours with RETR_TREE.
+        '''
+        self.contours = ContourStore(contours, hierarchy)
 
-        contours, current = [], []
-        for p in points:
-            current.append(p)
-            if any(np.array_equal(p, corner) for corner in corners):
-                contours.append(
-                    np.array(current, dtype=np.int32).reshape(-1, 1, 2)
-                )
-                current = [p]
+    @locked
+    def add_contour(self, points: np.ndarray) -> int:
+        '''Store a new contour and return its unique key.'''
+        return self.contours.add(points)
+
+    @locked
+    def remove_contour(self, key: int) -> np.ndarray:
+        '''Remove a contour and return its points.'''
+        return self.contours.pop(key)
 
-        # Create unique keys for new contours
-        keys = [max(self.contours) + i + 1 for i in range(len(contours))]
-        self.contours.update({k: Contour(c) for k, c in zip(keys, contours)})
-        self.contours.pop(key)
-        return keys
+    def find_contour(self, points: np.ndarray) -> int | None:
+        '''Key of the stored contour with exactly these points, if any.'''
+        return self.contours.find(points)
 
+    @locked
     def contour_roi(self, key: int, fraction: float = 0.05):
         if self.contours.get(key) is None:
             raise ValueError(f'Contour {key} not found')
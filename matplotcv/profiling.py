@@ -0,0 +1,120 @@
+'''
+Instrumentation of Pipeline operations. Methods decorated with profiled
+report their wall time, output shape and allocated bytes to the profiler
+attached to the pipeline, and cost a single attribute lookup when no
+profiler is attached.
+'''
+import json
+import time
+import functools
+import tracemalloc
+from dataclasses import dataclass, asdict
+
+
+@dataclass
+class Record:
+    '''Measurements of one call of a pipeline operation.'''
+    operation: str
+    start: float  # perf_counter at the beginning of the call, in seconds
+    duration: float
+    shape: tuple | None  # Shape of the processed image after the call
+    nbytes: int  # Size of the processed image after the call
+    contours: int  # Number of contours after the call
+    allocated: int | None = None  # Peak bytes allocated, when traced
+
+
+class Profiler:
+    '''Collects records and forwards them to registered hooks.'''
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.records = []
+        self.hooks = []
+
+    def add_hook(self, hook):
+        '''Register a callable invoked with every new record.'''
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def record(self, record: Record):
+        self.records.append(record)
+        for hook in self.hooks:
+            hook(record)
+
+    def clear(self):
+        self.records.clear()
+
+    def summary(self) -> dict[str, dict]:
+        '''Number of calls and total and mean durations per operation.'''
+        summary = {}
+        for r in self.records:
+            s = summary.setdefault(r.operation, {'calls': 0, 'total': 0.0})
+            s['calls'] += 1
+            s['total'] += r.duration
+
+        for s in summary.values():
+            s['mean'] = s['total'] / s['calls']
+        return summary
+
+    def export_trace(self, filename: str):
+        '''
+        Write the records in the Chrome trace event format, which can be
+        opened in chrome://tracing or Perfetto.
+        '''
+        events = [
+            {
+                'name': r.operation,
+                'ph': 'X',
+                'ts': r.start * 1e6,
+                'dur': r.duration * 1e6,
+                'pid': 0,
+                'tid': 0,
+                'args': {
+                    k: v
+                    for k, v in asdict(r).items()
+                    if k not in ('operation', 'start', 'duration')
+                },
+            } for r in self.records
+        ]
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events}, f)
+
+
+def profiled(method):
+    '''Record calls of a Pipeline method in the attached profiler.'''
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        profiler = self.profiler
+        if profiler is None:
+            return method(self, *args, **kwargs)
+
+        traced = profiler.trace_memory and tracemalloc.is_tracing()
+        if traced:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+        result = method(self, *args, **kwargs)
+        duration = time.perf_counter() - start
+
+        image = self.processed
+        profiler.record(
+            Record(
+                operation=method.__name__,
+                start=start,
+                duration=duration,
+                shape=None if image is None else image.shape,
+                nbytes=0 if image is None else image.nbytes,
+                contours=len(self.contours),
+                allocated=(
+                    tracemalloc.get_traced_memory()[1] -
+                    before if traced else None
+                ),
+            )
+        )
+        return result
+
+    return wrapper
@@ -0,0 +1,115 @@
+import numpy as np
+
+from metrics import point_segments_distance
+
+
+class SegmentIndex:
+    '''
+    Uniform grid over polyline segments. Answers "which polyline is
+    closest to this point" by only looking at the segments registered in
+    the grid cells around the point, each segment being registered in the
+    cells it runs through.
+    '''
+
+    def __init__(self, polylines: dict, cell: float | None = None):
+        starts, ends, owners = [], [], []
+        for key, points in polylines.items():
+            points = np.asarray(points, dtype=float).reshape(-1, 2)
+            if len(points) == 1:  # Single point contour
+                points = np.repeat(points, 2, axis=0)
+
+            starts.append(points[:-1])
+            ends.append(points[1:])
+            owners.append(np.full(len(points) - 1, key, dtype=np.int64))
+
+        if not starts or not sum(len(s) for s in starts):
+            self.starts = self.ends = np.empty([0, 2])
+            self.owners = np.empty(0, dtype=np.int64)
+            return
+
+        self.starts = np.concatenate(starts)
+        self.ends = np.concatenate(ends)
+        self.owners = np.concatenate(owners)
+
+        lengths = np.hypot(*(self.ends - self.starts).T)
+        if cell is None:  # Cells of roughly one typical segment
+            cell = np.median(lengths)
+        self.cell = max(float(cell), 1.0)
+
+        lo = np.minimum(self.starts, self.ends)
+        hi = np.maximum(self.starts, self.ends)
+        self.origin = lo.min(axis=0)
+        self.shape = ((hi.max(axis=0) - self.origin) // self.cell).astype(
+            np.int64
+        ) + 1  # Number of columns and rows
+
+        # Register each segment in the cells of points sampled along it
+        # at most one cell apart, so that the entries grow linearly with
+        # its length, e.g. for long diagonals of CHAIN_APPROX_SIMPLE
+        counts = np.ceil(lengths / self.cell).astype(np.int64) + 1
+        segments = np.repeat(np.arange(len(counts)), counts)
+        first = np.cumsum(counts) - counts
+        t = (np.arange(counts.sum()) - np.repeat(first, counts)) / np.repeat(
+            np.maximum(counts - 1, 1), counts
+        )
+        samples = self.starts[segments] + t[:, None] * (
+            self.ends[segments] - self.starts[segments]
+        )
+        c = np.clip(
+            ((samples - self.origin) // self.cell).astype(np.int64), 0,
+            self.shape - 1
+        )
+        cells = c[:, 1] * self.shape[0] + c[:, 0]
+
+        # Samples of a segment visit its cells in order, without return
+        keep = np.ones(len(cells), dtype=bool)
+        keep[1:] = cells[1:] != cells[:-1]
+        keep[first] = True
+        cells, segments = cells[keep], segments[keep]
+
+        order = np.argsort(cells, kind='stable')
+        self._cells = cells[order]
+        self._segments = segments[order]
+
+    def __len__(self):
+        return len(self.owners)
+
+    def candidates(self, x: float, y: float, radius: float) -> np.ndarray:
+        '''Indices of the segments registered around the point.'''
+        if not len(self):
+            return np.empty(0, dtype=np.int64)
+
+        # Every point of a segment is within half a cell of a sample
+        radius = radius + self.cell / 2
+        lo = np.floor((np.array([x, y]) - radius - self.origin) / self.cell)
+        hi = np.floor((np.array([x, y]) + radius - self.origin) / self.cell)
+        if np.any(hi < 0) or np.any(lo >= self.shape):
+            return np.empty(0, dtype=np.int64)
+
+        (cx0, cy0), (cx1, cy1) = (
+            np.clip(lo, 0, self.shape - 1).astype(np.int64),
+            np.clip(hi, 0, self.shape - 1).astype(np.int64),
+        )
+
+        # Cells of one grid row are stored contiguously
+        rows = np.arange(cy0, cy1 + 1) * self.shape[0]
+        first = np.searchsorted(self._cells, rows + cx0, side='left')
+        last = np.searchsorted(self._cells, rows + cx1, side='right')
+
+        return np.unique(
+            np.concatenate([self._segments[i:j] for i, j in zip(first, last)])
+        )
+
+    def nearest(self, x: float, y: float, radius: float) -> int | None:
+        '''Key of the closest polyline within radius from the point.'''
+        segments = self.candidates(x, y, radius)
+        if not len(segments):
+            return None
+
+        distances = point_segments_distance(
+            (x, y), self.starts[segments], self.ends[segments]
+        )
+        i = np.argmin(distances)
+        if distances[i] < radius:
+            return int(self.owners[segments[i]])
+        return None
@@ -0,0 +1,418 @@
+'''
+Streaming digitization of screen recordings, e.g. of oscilloscopes.
+
+Frames are read from a video file or a numbered image sequence in a
+background thread, a few frames ahead of the processing, and go through
+the Pipeline chain gray -> blur -> edges -> find_contours. Contours are
+tracked from frame to frame, and the points of all frames are written
+to one time-indexed .npz dataset with frame, time, track, x and y
+columns.
+
+Points are mapped to the user coordinates given ticks, image points of
+the first frame with their user coordinates. The tick contours are
+tracked like the others and the calibration is refitted to them on
+every frame, following e.g. a moving camera.
+
+    python streaming.py recording.mp4 -o traces.npz --size fhd
+    python streaming.py 'frames/frame_%04d.png' -o traces.npz --fps 25 \\
+        --tick 100,500,0,0 --tick 900,500,10,0 --tick 100,100,0,1
+'''
+import os
+import re
+import sys
+import queue
+import argparse
+import threading
+import numpy as np
+import cv2 as cv
+
+from exceptions import PipelineError
+from pipeline import Pipeline, sizes
+from calibration import Calibration, log_scales
+from batch import collect_files
+
+video_exts = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.m4v')
+
+
+def _frame_number(filename: str):
+    '''Sort key of numbered files, frame_10 coming after frame_9.'''
+    return [
+        int(part) if part.isdigit() else part
+        for part in re.split(r'(\d+)', os.path.basename(filename))
+    ]
+
+
+def iter_frames(source: str, fps: float | None = None):
+    '''
+    Yield the index, time in seconds and BGR image of each frame.
+
+    Parameters
+    ----------
+    source : str
+        Video file, printf-style pattern of numbered images such as
+        frame_%04d.png, or directory or glob pattern of images, sorted by
+        their number.
+    fps : float | None
+        Frame rate giving the frame times, by default the one of the
+        video, or 1 for images.
+    '''
+    if '%' in source or os.path.splitext(source)[1].lower() in video_exts:
+        capture = cv.VideoCapture(source)
+        if not capture.isOpened():
+            raise PipelineError(f'Failed to open {source}')
+
+        rate = fps or capture.get(cv.CAP_PROP_FPS) or 1.0
+        index = 0
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield index, index / rate, frame
+                index += 1
+        finally:
+            capture.release()
+    else:
+        files = sorted(collect_files(source), key=_frame_number)
+        if not files:
+            raise PipelineError(f'No frames found in {source}')
+
+        rate = fps or 1.0
+        for index, filename in enumerate(files):
+            frame = cv.imread(filename)
+            if frame is None:
+                raise PipelineError(f'Failed to load {filename}')
+            yield index, index / rate, frame
+
+
+def prefetch(iterable, depth: int = 4):
+    '''
+    Iterate in a background thread, at most depth items ahead of the
+    consumer, so that reading frames overlaps their processing while the
+    memory held by buffered frames stays bounded.
+    '''
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    end = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as e:
+            put((end, e))
+        else:
+            put((end, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if isinstance(item, tuple) and item and item[0] is end:
+                if item[1] is not None:
+                    raise item[1]
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class Tracker:
+    '''
+    Assigns persistent track ids to contours from frame to frame. Pairs
+    of contours of consecutive frames whose centroids are within
+    max_distance pixels are matched closest first, each contour
+    continuing at most one track, e.g. when the outer and inner contours
+    of a line have nearly the same centroid. Other contours start new
+    tracks.
+    '''
+
+    def __init__(self, max_distance: float = 20.0, chunk: int = 1024):
+        self.max_distance = max_distance
+        self.chunk = chunk  # Rows of the distance matrix computed at once
+        self.centroids = np.empty([0, 2])
+        self.tracks = np.empty(0, dtype=np.int64)
+        self._next_track = 0
+
+    def update(self, centroids: np.ndarray) -> np.ndarray:
+        '''Track ids of the contours of a new frame, given centroids.'''
+        centroids = np.asarray(centroids, dtype=float).reshape(-1, 2)
+        n = len(centroids)
+        tracks = np.full(n, -1, dtype=np.int64)
+
+        if n and len(self.centroids):
+            pairs, distances = [], []
+            for i in range(0, n, self.chunk):
+                d = np.linalg.norm(
+                    centroids[i:i + self.chunk, None] - self.centroids[None],
+                    axis=2,
+                )
+                rows, columns = np.nonzero(d <= self.max_distance)
+                pairs.append(np.stack([rows + i, columns], axis=1))
+                distances.append(d[rows, columns])
+
+            order = np.argsort(np.concatenate(distances), kind='stable')
+            continued = np.zeros(len(self.centroids), dtype=bool)
+            for i, j in np.concatenate(pairs)[order].tolist():
+                if tracks[i] < 0 and not continued[j]:
+                    tracks[i] = self.tracks[j]
+                    continued[j] = True
+
+        new = tracks < 0
+        tracks[new] = np.arange(
+            self._next_track, self._next_track + new.sum()
+        )
+        self._next_track += int(new.sum())
+
+        self.centroids, self.tracks = centroids, tracks
+        return tracks
+
+
+class TrackedCalibration:
+    '''
+    Calibration refitted on every frame to the tracked contours of the
+    ticks. Each tick is the contour of the first frame whose centroid is
+    closest to its image point, and the last fit carries over frames
+    where less than 3 ticks are tracked.
+    '''
+
+    def __init__(
+        self,
+        image_points: np.ndarray,
+        user_points: np.ndarray,
+        log_scale: str = 'OFF',
+        max_distance: float = 20.0,
+    ):
+        self.image_points = np.asarray(image_points, dtype=float)
+        self.image_points = self.image_points.reshape(-1, 2)
+        self.user_points = np.asarray(user_points, dtype=float)
+        self.user_points = self.user_points.reshape(-1, 2)
+        self.log_scale = log_scale
+        self.max_distance = max_distance
+        self.tracks = None  # Track of each tick, -1 if not found
+        self.calibration = None
+
+        # Checks the ticks before any frame is read
+        Calibration(self.image_points, self.user_points, log_scale)
+
+    def update(
+        self, centroids: np.ndarray, tracks: np.ndarray
+    ) -> Calibration | None:
+        '''Calibration of a frame given its contour centroids and tracks.'''
+        if self.tracks is None:  # First frame
+            d = np.linalg.norm(
+                self.image_points[:, None] - centroids[None], axis=2
+            )
+            nearest = np.argmin(d, axis=1)
+            found = d[np.arange(len(d)), nearest] <= self.max_distance
+            self.tracks = np.where(found, tracks[nearest], -1)
+
+        rows = np.flatnonzero(self.tracks[:, None] == tracks[None])
+        ticks, contours = np.divmod(rows, len(tracks))
+        if len(ticks) >= 3:
+            try:
+                self.calibration = Calibration(
+                    centroids[contours],
+                    self.user_points[ticks],
+                    self.log_scale,
+                )
+            except ValueError:  # E.g. collinear, keep the last fit
+                pass
+
+        return self.calibration
+
+
+def digitize_stream(
+    source: str,
+    output: str | None = None,
+    size: str | None = None,
+    blur: int = 1,
+    edges: str = 'canny',
+    external: bool = False,
+    calibration: Calibration | TrackedCalibration | None = None,
+    fps: float | None = None,
+    depth: int = 4,
+    max_distance: float = 20.0,
+) -> dict[str, np.ndarray]:
+    '''
+    Run the pipeline chain on every frame of a video or image sequence
+    and collect the contour points of all frames in one dataset.
+
+    Parameters
+    ----------
+    source : str
+        Video file or numbered image sequence, see iter_frames.
+    output : str | None
+        .npz file the dataset is written to, if given.
+    size, blur, edges, external
+        Pipeline chain options, see batch.process.
+    calibration : Calibration | TrackedCalibration | None
+        Map from the frame pixels, at the size preset, to the user
+        coordinates, either fixed or refitted on every frame to the
+        tracked ticks. Points are kept in pixels if not given.
+    fps : float | None
+        Frame rate, see iter_frames.
+    depth : int
+        Number of frames read ahead of the processing.
+    max_distance : float
+        Largest centroid displacement in pixels of a tracked contour
+        between consecutive frames.
+
+    Returns
+    -------
+    dict[str, np.ndarray]
+        Columns frame, time, track, x and y, with one row per point.
+    '''
+    pipeline = Pipeline()
+    tracker = Tracker(max_distance)
+    columns = {name: [] for name in ('frame', 'time', 'track', 'x', 'y')}
+
+    for index, time, frame in prefetch(iter_frames(source, fps), depth):
+        pipeline.load_array(frame, size)
+        pipeline.gray()
+        if blur > 0:
+            pipeline.blur('gaussian', blur)
+        pipeline.edges(edges)
+        pipeline.find_contours(external=external)
+
+        _, points, offsets = pipeline.contours.to_arrays()
+        lengths = np.diff(offsets)
+        if not len(lengths):
+            tracker.update(np.empty([0, 2]))
+            continue
+
+        centroids = np.add.reduceat(points, offsets[:-1], axis=0)
+        centroids = centroids / lengths[:, None]
+        tracks = tracker.update(centroids)
+
+        points = points.astype(float)
+        if isinstance(calibration, TrackedCalibration):
+            fit = calibration.update(centroids, tracks)
+            if fit is None:
+                raise PipelineError(f'Ticks not found in frame {index}')
+            points = fit.to_user(points)
+        elif calibration is not None:
+            points = calibration.to_user(points)
+
+        columns['frame'].append(np.full(len(points), index))
+        columns['time'].append(np.full(len(points), time))
+        columns['track'].append(np.repeat(tracks, lengths))
+        columns['x'].append(points[:, 0])
+        columns['y'].append(points[:, 1])
+
+    dataset = {
+        name: np.concatenate(values) if values else np.empty(0)
+        for name, values in columns.items()
+    }
+    if output is not None:
+        np.savez(output, **dataset)
+    return dataset
+
+
+def parse_tick(value: str) -> tuple[float]:
+    '''Tick given as x,y,u,v: image point x, y of user coordinates u, v.'''
+    try:
+        x, y, u, v = (float(c) for c in value.split(','))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(
+            f'Bad tick "{value}", expected x,y,u,v'
+        ) from e
+    return x, y, u, v
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Digitize the traces of a video or image sequence.'
+    )
+    parser.add_argument(
+        'source', help='Video file, image pattern such as frame_%%04d.png, '
+        'directory or glob pattern of images'
+    )
+    parser.add_argument(
+        '-o', '--output', default='traces.npz', help='Output .npz file'
+    )
+    parser.add_argument('--size', choices=sizes, help='Resize preset')
+    parser.add_argument(
+        '--blur',
+        type=int,
+        default=1,
+        help='Gaussian blur level, 0 to skip blurring'
+    )
+    parser.add_argument('--edges', default='canny', help='Edge detector')
+    parser.add_argument(
+        '--external',
+        action='store_true',
+        help='Only find the outermost contours'
+    )
+    parser.add_argument('--fps', type=float, help='Frame rate')
+    parser.add_argument(
+        '--max-distance',
+        type=float,
+        default=20.0,
+        help='Largest displacement in pixels of a tracked contour'
+    )
+    parser.add_argument(
+        '--tick',
+        type=parse_tick,
+        action='append',
+        metavar='X,Y,U,V',
+        help='Tick at pixel X, Y of the first frame, after resizing, of '
+        'user coordinates U, V, at least 3 to output user coordinates'
+    )
+    parser.add_argument(
+        '--log-scale',
+        choices=log_scales,
+        default='OFF',
+        help='Logarithmic axes of the user coordinates'
+    )
+    args = parser.parse_args(argv)
+
+    calibration = None
+    if args.tick:
+        ticks = np.array(args.tick)
+        try:
+            calibration = TrackedCalibration(
+                ticks[:, :2], ticks[:, 2:], args.log_scale, args.max_distance
+            )
+        except ValueError as e:
+            parser.error(str(e))
+
+    try:
+        dataset = digitize_stream(
+            args.source,
+            args.output,
+            size=args.size,
+            blur=args.blur,
+            edges=args.edges,
+            external=args.external,
+            calibration=calibration,
+            fps=args.fps,
+            max_distance=args.max_distance,
+        )
+    except PipelineError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    frames = len(np.unique(dataset['frame']))
+    tracks = len(np.unique(dataset['track']))
+    print(
+        f'Wrote {len(dataset["x"])} points of {tracks} tracks in {frames} '
+        f'frames to {args.output}'
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
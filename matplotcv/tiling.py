@@ -0,0 +1,302 @@
+'''
+Tiled processing of images too large to be held in memory several
+times over. Gray, blur and edges run tile by tile on regions padded with
+a halo wide enough for the filters, while Canny hysteresis and the
+contours of edges spanning several tiles are resolved across tiles.
+'''
+import os.path
+import numpy as np
+import cv2 as cv
+
+from exceptions import PipelineError
+from imagestats import ImageStats, histogram, canny_thresholds
+
+
+def open_source(source: str | np.ndarray) -> np.ndarray:
+    '''
+    Open an image for tiled reading. Arrays, including np.memmap, are
+    used as they are and .npy files are memory-mapped. Other formats
+    cannot be decoded partially by OpenCV, so they are decoded once in
+    grayscale, which is all the tiled chain needs.
+    '''
+    if isinstance(source, np.ndarray):
+        return source
+
+    if os.path.splitext(source)[1].lower() == '.npy':
+        return np.load(source, mmap_mode='r')
+
+    image = cv.imread(source, cv.IMREAD_GRAYSCALE)
+    if image is None:
+        raise PipelineError('Failed to load image')
+    return image
+
+
+def iter_tiles(shape: tuple[int], tile: int, halo: int = 0):
+    '''
+    Iterate over tiles in raster order. Yields the core region of the
+    tile as (y0, y1, x0, x1) and the same region padded with the halo
+    and clipped to the image.
+    '''
+    h, w = shape[:2]
+    for y0 in range(0, h, tile):
+        for x0 in range(0, w, tile):
+            y1, x1 = min(y0 + tile, h), min(x0 + tile, w)
+            yield (y0, y1, x0, x1), (
+                max(0, y0 - halo),
+                min(h, y1 + halo),
+                max(0, x0 - halo),
+                min(w, x1 + halo),
+            )
+
+
+def _gray_blur(region: np.ndarray, k: int) -> np.ndarray:
+    if region.ndim == 3:
+        region = cv.cvtColor(np.asarray(region), cv.COLOR_BGR2GRAY)
+    if k:
+        region = cv.GaussianBlur(np.asarray(region), (k, k), 0)
+    return region
+
+
+def tiled_edges(
+    source: np.ndarray,
+    tile: int = 2048,
+    k: int = 5,
+    sigma: float = 0.33,
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    '''
+    Compute the Canny edge map of an image tile by tile, the same as
+    cv.Canny on the whole blurred image.
+
+    Canny hysteresis keeps the weak edges connected to a strong edge at
+    any distance, so it cannot be done within padded tiles. Instead, the
+    weak and strong edges, whose gradient is above the lower and upper
+    threshold and maximal across the edge, are found in each tile, and
+    the weak edges are kept by component of 8-connected pixels merged
+    across tile borders, if the component has a strong pixel.
+
+    Parameters
+    ----------
+    source : np.ndarray
+        BGR or grayscale image, possibly memory-mapped.
+    tile : int
+        Side of the square tiles.
+    k : int
+        Gaussian blur kernel size, 0 to skip blurring.
+    sigma : float
+        Spread of the automatic Canny thresholds around the median.
+    out : np.ndarray | None
+        uint8 array receiving the edge map, e.g. an np.memmap. A new
+        array is allocated if not given.
+
+    Returns
+    -------
+    np.ndarray
+        Edge map of the source shape.
+    '''
+    h, w = source.shape[:2]
+    halo = k // 2 + 8  # Blur footprint plus Sobel and suppression support
+
+    # The thresholds depend on the median of the whole blurred image,
+    # which is accumulated in a first pass as a histogram
+    hist = np.zeros(256, dtype=np.int64)
+    for (y0, y1, x0, x1), (py0, py1, px0, px1) in iter_tiles(
+        source.shape, tile, halo
+    ):
+        region = _gray_blur(source[py0:py1, px0:px1], k)
+        core = region[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+        hist += histogram(core)
+
+    lower, upper = canny_thresholds(ImageStats(hist).median, sigma)
+
+    if out is None:
+        out = np.empty([h, w], dtype=np.uint8)
+
+    # Weak edges are written to out and labeled, cv.Canny with equal
+    # thresholds returning the edges above them without hysteresis
+    labeler = _TileLabeler(w)
+    offsets = {}  # Label offset of each tile by its origin
+    strong = []  # Labels of the components with strong pixels
+    for (y0, y1, x0, x1), (py0, py1, px0, px1) in iter_tiles(
+        source.shape, tile, halo
+    ):
+        region = _gray_blur(source[py0:py1, px0:px1], k)
+        core = np.s_[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+        weak = cv.Canny(region, lower, lower)[core]
+        out[y0:y1, x0:x1] = weak
+
+        offsets[y0, x0] = labeler.offset
+        labels = labeler.label((y0, y1, x0, x1), weak)
+        strong.append(labels[cv.Canny(region, upper, upper)[core] > 0])
+
+    find = labeler.components.find
+    strong_roots = {find(i) for i in np.unique(np.concatenate(strong))}
+
+    # Hysteresis, the labels of each tile being the same as above
+    for (y0, y1, x0, x1), _ in iter_tiles(source.shape, tile):
+        n, labels = cv.connectedComponents(
+            np.ascontiguousarray(out[y0:y1, x0:x1]), connectivity=8
+        )
+        offset = offsets[y0, x0]
+        keep = np.array(
+            [find(offset + i) in strong_roots for i in range(n)], dtype=bool
+        )
+        keep[0] = False
+        out[y0:y1, x0:x1] = np.where(keep[labels], 255, 0)
+
+    return out
+
+
+class _UnionFind:
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, i):
+        root = i
+        while self.parent.get(root, root) != root:
+            root = self.parent[root]
+        while i != root:  # Path compression
+            self.parent[i], i = root, self.parent.get(i, i)
+        return root
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i != j:
+            self.parent[max(i, j)] = min(i, j)
+
+
+def _border_pairs(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    '''
+    Pairs of nonzero labels of 8-connected pixels across a border, a
+    being the labels along the border and b the labels on the other
+    side, b having one more pixel at both ends.
+    '''
+    pairs = [np.stack([a, b[d:d + len(a)]], axis=1) for d in range(3)]
+    pairs = np.concatenate(pairs)
+    return np.unique(pairs[(pairs > 0).all(axis=1)], axis=0)
+
+
+class _TileLabeler:
+    '''
+    Labels the 8-connected components of nonzero pixels of binary tiles
+    given in raster order. Labels are unique across tiles, and the labels
+    of pixels connected across tile borders are merged in components.
+    '''
+
+    def __init__(self, width: int):
+        self.width = width
+        self.components = _UnionFind()
+        self.offset = 0  # Labels of the next tile start above the offset
+
+        # Labels along the bottom row of the previous row of tiles,
+        # padded by one pixel to look up diagonal neighbours
+        self._above = np.zeros(width + 2, dtype=np.int64)
+        self._below = np.zeros(width + 2, dtype=np.int64)
+        self._left = None  # Right column of the previous tile in the row
+
+    def label(self, box: tuple[int], core: np.ndarray) -> np.ndarray:
+        '''Labels of the tile with the given core region (y0, y1, x0, x1).'''
+        y0, y1, x0, x1 = box
+        n, labels = cv.connectedComponents(
+            np.ascontiguousarray(core), connectivity=8
+        )
+        labels = np.where(labels > 0, labels + self.offset, 0)
+        labels = labels.astype(np.int64)
+
+        if y0 > 0:
+            above = self._above[x0:x1 + 2]
+            for i, j in _border_pairs(labels[0], above):
+                self.components.union(i, j)
+        if x0 > 0:
+            left = np.concatenate([[0], self._left, [0]])
+            for i, j in _border_pairs(labels[:, 0], left):
+                self.components.union(i, j)
+
+        self._below[x0 + 1:x1 + 1] = labels[-1]
+        self._left = labels[:, -1]
+        if x1 == self.width:  # Last tile in the row
+            self._above, self._below = self._below, self._above
+
+        self.offset += n
+        return labels
+
+
+def tiled_contours(edges: np.ndarray, tile: int = 2048) -> list[np.ndarray]:
+    '''
+    Find the contours of an edge map tile by tile, the same as
+    cv.findContours with RETR_LIST and CHAIN_APPROX_SIMPLE on the whole
+    map up to their order.
+
+    The contours of components of edge pixels lying within one tile are
+    found in that tile. Components spanning several tiles are drawn
+    alone into a mask of their bounding box, in which their contours are
+    found whole, so that their outer and hole contours stay separate.
+    Besides the tiles, memory is bounded by the number of edge pixels of
+    components reaching tile borders and the bounding box of the largest
+    spanning component.
+    '''
+    h, w = edges.shape
+    labeler = _TileLabeler(w)
+
+    pieces = []  # Label and contour found in each tile
+    touching = []  # Labels and coordinates of pixels of border components
+    for (y0, y1, x0, x1), _ in iter_tiles(edges.shape, tile):
+        core = np.ascontiguousarray(edges[y0:y1, x0:x1])
+        labels = labeler.label((y0, y1, x0, x1), core)
+
+        border = np.unique(
+            np.concatenate(
+                [labels[0], labels[-1], labels[:, 0], labels[:, -1]]
+            )
+        )
+        border = border[border > 0]
+        if len(border):
+            ys, xs = np.nonzero(np.isin(labels, border))
+            touching.append((labels[ys, xs], ys + y0, xs + x0))
+
+        contours, _ = cv.findContours(
+            core, cv.RETR_LIST, cv.CHAIN_APPROX_SIMPLE
+        )
+        for contour in contours:
+            x, y = contour[0, 0]  # Contours run along their own pixels
+            pieces.append((labels[y, x], contour + np.array([x0, y0])))
+
+    if not touching:
+        return [contour.astype(np.int32) for _, contour in pieces]
+
+    labels, ys, xs = (np.concatenate(a) for a in zip(*touching))
+    unique, inverse = np.unique(labels, return_inverse=True)
+    roots = np.array([labeler.components.find(i) for i in unique])
+    root_labels, counts = np.unique(roots, return_counts=True)
+    spanning = np.isin(roots, root_labels[counts > 1])
+
+    spanning_labels = set(unique[spanning].tolist())
+    contours = [
+        contour.astype(np.int32) for label, contour in pieces
+        if label not in spanning_labels
+    ]
+
+    # Pixels of the spanning components, grouped by component
+    selected = spanning[inverse]
+    roots, ys, xs = roots[inverse][selected], ys[selected], xs[selected]
+    if not len(roots):
+        return contours
+
+    order = np.argsort(roots, kind='stable')
+    roots, ys, xs = roots[order], ys[order], xs[order]
+    bounds = np.flatnonzero(np.diff(roots)) + 1
+
+    for cy, cx in zip(np.split(ys, bounds), np.split(xs, bounds)):
+        by, bx = cy.min(), cx.min()
+        mask = np.zeros([cy.max() - by + 1, cx.max() - bx + 1], np.uint8)
+        mask[cy - by, cx - bx] = 255
+        found, _ = cv.findContours(
+            mask, cv.RETR_LIST, cv.CHAIN_APPROX_SIMPLE
+        )
+        contours.extend(
+            (contour + np.array([bx, by])).astype(np.int32)
+            for contour in found
+        )
+
+    return contours
@@ -0,0 +1,82 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from kivy.clock import Clock
+from kivy.logger import Logger
+
+
+class Worker:
+    '''
+    Runs pipeline operations off the Kivy main thread. OpenCV releases
+    the GIL, so the UI keeps running while images are processed.
+
+    Operations run one after the other on a single background thread,
+    since they all modify the same pipeline. Each submission may belong
+    to a channel, in which case it supersedes the earlier submissions on
+    that channel: those not started yet are cancelled and the results of
+    those already running are dropped. Callbacks are called on the main
+    thread.
+    '''
+
+    def __init__(self, on_busy=None):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.on_busy = on_busy
+        self._pending = set()
+        self._latest = {}  # Latest future of each channel
+
+    @property
+    def busy(self) -> bool:
+        return bool(self._pending)
+
+    def submit(
+        self,
+        fn,
+        *args,
+        channel: str | None = None,
+        on_done=None,
+        on_error=None,
+        **kwargs,
+    ) -> Future:
+        '''Run fn(*args, **kwargs) in the background.'''
+        previous = self._latest.get(channel)
+        if channel is not None and previous is not None:
+            if previous.cancel():
+                self._pending.discard(previous)
+
+        future = self.executor.submit(fn, *args, **kwargs)
+        if channel is not None:
+            self._latest[channel] = future
+        self._pending.add(future)
+        self._notify()
+
+        future.add_done_callback(
+            lambda f: Clock.schedule_once(
+                lambda dt: self._deliver(f, channel, on_done, on_error)
+            )
+        )
+        return future
+
+    def _deliver(self, future: Future, channel, on_done, on_error):
+        self._pending.discard(future)
+        self._notify()
+
+        if future.cancelled():
+            return
+        if channel is not None:
+            if self._latest.get(channel) is not future:  # Superseded
+                return
+            del self._latest[channel]
+
+        error = future.exception()
+        if error is not None:
+            Logger.error(f'Worker: {type(error).__name__}: {error}')
+            if on_error is not None:
+                on_error(error)
+        elif on_done is not None:
+            on_done(future.result())
+
+    def _notify(self):
+        if self.on_busy is not None:
+            self.on_busy(self.busy)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)